@@ -0,0 +1,172 @@
+import heapq
+import math
+
+NEG_INF = float("-inf")
+
+class AgendaParser(object):
+  """ Knuth-style best-first parsing over a trained CFG.
+
+  Items (label, i, j) are popped from an agenda in order of their
+  probability, times an outside estimate when A* is on, and only popped
+  items are combined with their neighbours. Parsing stops as soon as TOP
+  over the whole sentence is popped.
+
+  Inside scores are products of probabilities computed exactly as in
+  CFG.cky, and equal-scoring derivations are broken the same way, by the
+  earliest split and then the earliest rule, so the tree is the one
+  CFG.cky returns. The number of rule applications made is left in
+  self.edges.
+  """
+  def __init__(self, cfg):
+    self.cfg = cfg
+    self.rules = list(cfg.rules)
+    self.by_base = {}
+    for rule in self.rules:
+      self.by_base.setdefault(rule.base, []).append(rule)
+    self.binary = [(rule, math.log(cfg.probability_table()[rule]))
+        for rule in self.rules if len(rule.goes_to) == 2]
+    self.edges = 0
+
+    # Outside estimates, extended as longer sentences come in
+    self._inside_estimate = {}
+    self._outside_estimate = {}
+    self._estimate_length = 0
+
+  def _extend_estimates(self, n):
+    """ Computes, for every label A and number of words m < n, the best log
+    inside score of A over any m words and the best log outside score of A
+    with any m words outside it. They only depend on the grammar, and their
+    sum bounds the score of any parse that uses A. """
+    if n <= self._estimate_length:
+      return
+    table = self.cfg.probability_table()
+    inside = dict((base, [NEG_INF] * n) for base in self.by_base)
+    outside = dict((base, [NEG_INF] * n) for base in self.by_base)
+    for rule in self.binary:
+      for child in rule[0].goes_to:
+        inside.setdefault(child, [NEG_INF] * n)
+        outside.setdefault(child, [NEG_INF] * n)
+
+    # Any rule may rewrite to a single word, since CFG.cky looks words up
+    # among all of a rule's children
+    for base, rules in self.by_base.items():
+      if n > 1:
+        inside[base][1] = max(math.log(table[rule]) for rule in rules)
+    for m in range(2, n):
+      for rule, logp in self.binary:
+        Y, Z = rule.goes_to
+        for a in range(1, m):
+          score = logp + inside[Y][a] + inside[Z][m-a]
+          if score > inside[rule.base][m]:
+            inside[rule.base][m] = score
+
+    if 'TOP' in outside:
+      outside['TOP'][0] = 0.0
+    for m in range(1, n):
+      for rule, logp in self.binary:
+        Y, Z = rule.goes_to
+        parent = outside[rule.base]
+        for c in range(1, m+1):
+          if parent[m-c] == NEG_INF:
+            continue
+          score = parent[m-c] + logp
+          if score + inside[Z][c] > outside[Y][m]:
+            outside[Y][m] = score + inside[Z][c]
+          if score + inside[Y][c] > outside[Z][m]:
+            outside[Z][m] = score + inside[Y][c]
+
+    self._inside_estimate = inside
+    self._outside_estimate = outside
+    self._estimate_length = n
+
+  def parse(self, string, heuristic=True):
+    """ Finds the highest probability parse of a given string
+    """
+    cfg = self.cfg
+    words = string.strip().split(" ")
+    n = len(words)
+    if heuristic:
+      self._extend_estimates(n + 1)
+    outside = self._outside_estimate
+
+    best = {}         # (i, j) -> {label: probability}
+    back = {}         # (i, j) -> {label: [rule, i, j, k]}, as CFG.cky's chart
+    index_of = {}     # (i, j) -> {label: position in cfg.rules of its rule}
+    done_from = [dict() for i in range(n+1)]  # i -> {j: {label: probability}}
+    done_to = [dict() for i in range(n+1)]    # j -> {i: {label: probability}}
+    agenda = []
+    edges = 0
+
+    def push(label, i, j, p):
+      if heuristic:
+        estimate = outside.get(label)
+        if estimate is None or estimate[n-(j-i)] == NEG_INF:
+          # Can never be part of a TOP over the whole sentence
+          return
+        priority = math.log(p) + estimate[n-(j-i)]
+      else:
+        priority = math.log(p)
+      heapq.heappush(agenda, (-priority, j-i, i, j, label, p))
+
+    def relax(rule, index, i, j, k, p):
+      span = (i, j)
+      cell_best = best.setdefault(span, {})
+      current = cell_best.get(rule.base, 0.0)
+      if p > current or (p == current and p > 0.0 and
+          (k, index) < (back[span][rule.base][3], index_of[span][rule.base])):
+        cell_best[rule.base] = p
+        back.setdefault(span, {})[rule.base] = [rule, i, j, k]
+        index_of.setdefault(span, {})[rule.base] = index
+        if p > current:
+          push(rule.base, i, j, p)
+
+    # Do top row
+    for i in range(1, n+1):
+      word = words[i-1]
+      if word not in cfg.words_seen:
+        word = "<unk>"
+      for rule, p, logp in cfg.lexicon.get(word, ()):
+        edges += 1
+        span = (i-1, i)
+        cell_best = best.setdefault(span, {})
+        if p > cell_best.get(rule.base, 0.0):
+          cell_best[rule.base] = p
+          back.setdefault(span, {})[rule.base] = [rule, i, None, None]
+          push(rule.base, i-1, i, p)
+
+    found = False
+    while agenda:
+      _, _, i, j, label, p = heapq.heappop(agenda)
+      if p != best[i, j][label] or label in done_from[i].get(j, ()):
+        # Stale entry, or already finished
+        continue
+      done_from[i].setdefault(j, {})[label] = p
+      done_to[j].setdefault(i, {})[label] = p
+      if label == 'TOP' and i == 0 and j == n:
+        found = True
+        break
+
+      # As a left child, with finished items starting at j
+      by_right = cfg.binary_by_left.get(label)
+      if by_right:
+        for k2, labels in done_from[j].items():
+          for Z, z_prob in labels.items():
+            for index, rule, rule_p, logp in by_right.get(Z, ()):
+              edges += 1
+              relax(rule, index, i, k2, j, rule_p * p * z_prob)
+
+      # As a right child, with finished items ending at i
+      for k0, labels in done_to[i].items():
+        for Y, y_prob in labels.items():
+          entries = cfg.binary_by_pair.get((Y, label))
+          if entries is None:
+            continue
+          for index, rule, rule_p, logp in entries:
+            edges += 1
+            relax(rule, index, k0, j, i, rule_p * y_prob * p)
+
+    self.edges = edges
+    if not found:
+      return None
+    chart = [[back.get((i, j), {}) for j in range(n+1)] for i in range(n+1)]
+    return cfg._backtrack(chart, n)
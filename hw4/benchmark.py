@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+
+""" Compares the CKY engines in main.ENGINES by sentence length.
+
+usage: benchmark.py [strings-file] [--bucket N] [--repeat N]
+"""
+
+from collections import defaultdict
+from main import CFG, ENGINES
+
+import argparse
+import time
+
+def time_engine(engine, cfg, line, repeat):
+  """ Returns the best wall time of repeat runs, the resulting parse and the
+  number of rule applications, if the engine counts them. The applications
+  are counted in one more, untimed run with instrumentation on.
+  """
+  best_time = None
+  for i in range(repeat):
+    start = time.perf_counter()
+    result = engine(cfg, line)
+    elapsed = time.perf_counter() - start
+    if best_time is None or elapsed < best_time:
+      best_time = elapsed
+
+  cfg.edges = None
+  cfg.instrument = True
+  try:
+    engine(cfg, line)
+  finally:
+    cfg.instrument = False
+    cfg.chart_stats = None
+  return best_time, result, cfg.edges
+
+def main():
+  argparser = argparse.ArgumentParser()
+  argparser.add_argument('strings', nargs='?', default='dev.strings', help='file with one sentence per line')
+  argparser.add_argument('--bucket', type=int, default=5, help='width of each sentence length bucket')
+  argparser.add_argument('--repeat', type=int, default=3, help='runs per sentence and engine')
+  args = argparser.parse_args()
+
+  cfg = CFG()
+  cfg.train("train.trees.pre.unk")
+  # The coarse pass of the c2f engine, which would otherwise run an
+  # exhaustive cky_log
+  cfg.coarse = CFG()
+  cfg.coarse.train("train.trees.pre.unk", False)
+  names = sorted(ENGINES)
+
+  # Warm up, so that building the indexes is not counted against one sentence
+  for name in names:
+    ENGINES[name](cfg, "warm up")
+
+  times = defaultdict(lambda: defaultdict(float))
+  edges = defaultdict(lambda: defaultdict(int))
+  counts = defaultdict(int)
+  mismatches = 0
+  with open(args.strings) as stringFile:
+    for line in stringFile:
+      n = len(line.strip().split(" "))
+      bucket = (n - 1) // args.bucket
+      counts[bucket] += 1
+      results = set()
+      for name in names:
+        elapsed, result, line_edges = time_engine(ENGINES[name], cfg, line, args.repeat)
+        times[bucket][name] += elapsed
+        if line_edges is None or edges[bucket][name] is None:
+          edges[bucket][name] = None
+        else:
+          edges[bucket][name] += line_edges
+        results.add(result)
+      if len(results) > 1:
+        mismatches += 1
+
+  header = "%-9s %9s" % ("length", "sentences")
+  for name in names:
+    header += " %12s" % (name + " ms")
+  print(header)
+  for bucket in sorted(counts):
+    low = bucket * args.bucket + 1
+    row = "%-9s %9d" % ("%d-%d" % (low, low + args.bucket - 1), counts[bucket])
+    for name in names:
+      row += " %12.2f" % (1000 * times[bucket][name] / counts[bucket])
+    print(row)
+
+  total = sum(counts.values())
+  row = "%-9s %9d" % ("all", total)
+  for name in names:
+    row += " %12.2f" % (1000 * sum(times[bucket][name] for bucket in counts) / total)
+  print(row)
+  print("sentences with differing parses: %d" % mismatches)
+
+  # Rule applications per sentence, for the engines that count them
+  counted = [name for name in names if all(edges[bucket][name] is not None for bucket in counts)]
+  if counted:
+    print("")
+    header = "%-9s %9s" % ("length", "sentences")
+    for name in counted:
+      header += " %12s" % (name + " edges")
+    print(header)
+    for bucket in sorted(counts):
+      low = bucket * args.bucket + 1
+      row = "%-9s %9d" % ("%d-%d" % (low, low + args.bucket - 1), counts[bucket])
+      for name in counted:
+        row += " %12.1f" % (float(edges[bucket][name]) / counts[bucket])
+      print(row)
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+
+""" Trades grammar size against parsing speed and accuracy.
+
+usage: compact.py [strings-file] [gold-file] [--min-count N...]
+                  [--min-probability P...] [--merge-below N...]
+
+Trains the grammars used by main.py, compacts them with CFG.compact for
+every combination of the given settings, and reports the number of rules
+and labels, the time to parse the strings with the cky engine and the F1
+of the parses against the gold trees.
+"""
+
+from main import CFG, Parser
+from postprocess import postprocess
+
+import argparse
+import evalb
+import itertools
+import time
+
+def main():
+  argparser = argparse.ArgumentParser()
+  argparser.add_argument('strings', nargs='?', default='dev.strings', help='file with one sentence per line')
+  argparser.add_argument('gold', nargs='?', default='dev.trees', help='gold trees for the strings')
+  argparser.add_argument('--treebank', default='train.trees.pre.unk', help='preprocessed training trees')
+  argparser.add_argument('--min-count', type=int, nargs='+', default=[1, 2, 3], help='drop rules seen fewer times')
+  argparser.add_argument('--min-probability', type=float, nargs='+', default=[0.0], help='drop rules less likely')
+  argparser.add_argument('--merge-below', type=int, nargs='+', default=[0, 5, 20], help='merge parent-annotated labels seen fewer times')
+  args = argparser.parse_args()
+
+  cfg = CFG()
+  no_markovization = CFG()
+  cfg.train(args.treebank)
+  no_markovization.train(args.treebank, False)
+
+  with open(args.strings) as stringFile:
+    lines = stringFile.readlines()
+  gold = evalb.read_gold(args.gold)
+
+  print("%9s %9s %9s %9s %9s %9s %12s %9s" % ("min count", "min prob", "merge", "rules",
+      "labels", "seconds", "sentences/s", "F1"))
+  for min_count, min_probability, merge_below in itertools.product(args.min_count,
+      args.min_probability, args.merge_below):
+    compacted = cfg.compact(min_count, min_probability, merge_below)
+    parser = Parser(compacted, no_markovization.compact(min_count, min_probability))
+    # Build the indexes before timing
+    compacted.finalize()
+    parser.no_markovization.finalize()
+
+    start = time.time()
+    parses = [postprocess(parser.parse(line)[0]) for line in lines]
+    elapsed = time.time() - start
+
+    total = evalb.Score()
+    for score in evalb.score_lines(parses, gold):
+      total += score
+    print("%9d %9g %9d %9d %9d %9.3f %12.1f %9.4f" % (min_count, min_probability, merge_below,
+        len(compacted), len(compacted.bases), elapsed, len(lines) / max(elapsed, 1e-9), total.f1()))
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+
+""" Compiled, memory-mappable form of a trained CFG.
+
+usage: compiled.py [treebank] [--output PREFIX]
+
+Trains the grammars used by main.py and writes PREFIX.bin (with vertical
+markovization) and PREFIX.nomarkov.bin (without). main.py --grammar PREFIX
+loads them instead of training.
+
+A compiled grammar is a header followed by flat arrays, all in native byte
+order and 8-byte aligned:
+
+  strings       every symbol and word, sorted, as one utf-8 blob plus
+                offsets; a string's position in this table is its ID
+  seen          1 for the strings that were seen as words in training
+  rules         base, first child, second child (-1 if none), probability
+                and log-probability of every rule, in CFG.rules order
+  lexicon       for every string, the rules that have it as a child
+  binary        for every left child, the right children it pairs with, and
+                for every pair the binary rules that rewrite to it
+"""
+
+from collections import defaultdict
+
+import array
+import bisect
+import math
+import mmap
+import struct
+import sys
+
+MAGIC = b"CKYG"
+VERSION = 1
+BYTE_ORDER_MARK = 0x01020304
+
+# (name, array typecode) of every section, in file order
+SECTIONS = [
+  ("string_blob", "B"),
+  ("string_offsets", "I"),
+  ("seen", "B"),
+  ("rule_base", "I"),
+  ("rule_first", "I"),
+  ("rule_second", "i"),
+  ("rule_prob", "d"),
+  ("rule_logprob", "d"),
+  ("lexicon_offsets", "I"),
+  ("lexicon_rules", "I"),
+  ("left_offsets", "I"),
+  ("pair_right", "I"),
+  ("pair_offsets", "I"),
+  ("pair_rules", "I"),
+]
+
+HEADER = struct.Struct("=4sII")
+SECTION = struct.Struct("=QQ")
+
+class GrammarVersionError(Exception):
+  pass
+
+def compile_grammar(cfg, filename):
+  """ Writes a trained CFG to filename in the compiled format
+  """
+  table = cfg.probability_table()
+  rules = list(cfg.rules)
+
+  strings = set(cfg.words_seen)
+  for rule in rules:
+    strings.add(rule.base)
+    strings.update(rule.goes_to)
+  strings = sorted(strings, key=lambda s: s.encode("utf-8"))
+  ids = {s: i for i, s in enumerate(strings)}
+
+  data = dict((name, array.array(typecode)) for name, typecode in SECTIONS)
+
+  data["string_offsets"].append(0)
+  for s in strings:
+    data["string_blob"].frombytes(s.encode("utf-8"))
+    data["string_offsets"].append(len(data["string_blob"]))
+    data["seen"].append(1 if s in cfg.words_seen else 0)
+
+  lexicon = defaultdict(list)
+  binary = defaultdict(lambda: defaultdict(list))
+  for index, rule in enumerate(rules):
+    data["rule_base"].append(ids[rule.base])
+    data["rule_first"].append(ids[rule.goes_to[0]])
+    data["rule_second"].append(ids[rule.goes_to[1]] if len(rule.goes_to) > 1 else -1)
+    data["rule_prob"].append(table[rule])
+    data["rule_logprob"].append(math.log(table[rule]))
+    for token in set(rule.goes_to):
+      lexicon[ids[token]].append(index)
+    if len(rule.goes_to) == 2:
+      binary[ids[rule.goes_to[0]]][ids[rule.goes_to[1]]].append(index)
+
+  data["lexicon_offsets"].append(0)
+  data["left_offsets"].append(0)
+  data["pair_offsets"].append(0)
+  for i in range(len(strings)):
+    data["lexicon_rules"].extend(lexicon[i])
+    data["lexicon_offsets"].append(len(data["lexicon_rules"]))
+    for right in sorted(binary[i]):
+      data["pair_right"].append(right)
+      data["pair_rules"].extend(binary[i][right])
+      data["pair_offsets"].append(len(data["pair_rules"]))
+    data["left_offsets"].append(len(data["pair_right"]))
+
+  with open(filename, "wb") as grammarFile:
+    grammarFile.write(HEADER.pack(MAGIC, VERSION, BYTE_ORDER_MARK))
+    offset = HEADER.size + SECTION.size * len(SECTIONS)
+    layout = []
+    for name, typecode in SECTIONS:
+      offset = _align(offset)
+      size = len(data[name]) * data[name].itemsize
+      layout.append((offset, size))
+      offset += size
+    for section in layout:
+      grammarFile.write(SECTION.pack(*section))
+    for (name, typecode), (offset, size) in zip(SECTIONS, layout):
+      grammarFile.write(b"\0" * (offset - grammarFile.tell()))
+      data[name].tofile(grammarFile)
+
+def _align(offset):
+  return (offset + 7) // 8 * 8
+
+class CompiledGrammar(object):
+  """ A grammar written by compile_grammar, mapped read-only into memory.
+
+  Nothing is decoded up front, so loading takes constant time, and every
+  process that maps the same file shares its pages. cky gives the same
+  parses as CFG.cky on the grammar that was compiled.
+  """
+  def __init__(self, filename):
+    self.filename = filename
+    with open(filename, "rb") as grammarFile:
+      self._mmap = mmap.mmap(grammarFile.fileno(), 0, access=mmap.ACCESS_READ)
+    view = memoryview(self._mmap)
+
+    magic, version, mark = HEADER.unpack_from(view, 0)
+    if magic != MAGIC:
+      raise GrammarVersionError(filename + " is not a compiled grammar")
+    if version != VERSION or mark != BYTE_ORDER_MARK:
+      raise GrammarVersionError(filename + " was compiled by another version or on another platform")
+
+    for n, (name, typecode) in enumerate(SECTIONS):
+      offset, size = SECTION.unpack_from(view, HEADER.size + n * SECTION.size)
+      setattr(self, name, view[offset:offset + size].cast(typecode))
+
+    self.num_strings = len(self.seen)
+    self._ids = {}
+    self._names = {}
+    self.top = self.string_id("TOP")
+
+  def finalize(self):
+    """ Compiled grammars are always final """
+    pass
+
+  def string(self, i):
+    """ Returns the symbol or word with the given ID
+    """
+    if i not in self._names:
+      self._names[i] = bytes(self.string_blob[self.string_offsets[i]:self.string_offsets[i+1]]).decode("utf-8")
+    return self._names[i]
+
+  def string_id(self, s):
+    """ Returns the ID of a symbol or word, or None if it is not in the grammar
+    """
+    if s not in self._ids:
+      key = s.encode("utf-8")
+      strings = _StringTable(self)
+      i = bisect.bisect_left(strings, key)
+      self._ids[s] = i if i < self.num_strings and strings[i] == key else None
+    return self._ids[s]
+
+  def cky(self, string):
+    """ Finds the highest probability parse of a given string
+    """
+    words = string.strip().split(" ")
+    n = len(words)
+
+    chart = [[dict() for i in range(n+1)] for i in range(n+1)]
+    best = [[dict() for i in range(n+1)] for i in range(n+1)]
+
+    rule_base = self.rule_base
+    rule_prob = self.rule_prob
+    left_offsets = self.left_offsets
+    pair_right = self.pair_right
+    pair_offsets = self.pair_offsets
+    pair_rules = self.pair_rules
+
+    # Do top row
+    unk = self.string_id("<unk>")
+    for i in range(1, n+1):
+      word = self.string_id(words[i-1])
+      if word is None or not self.seen[word]:
+        word = unk
+      if word is None:
+        continue
+      cell_best = best[i-1][i]
+      for offset in range(self.lexicon_offsets[word], self.lexicon_offsets[word+1]):
+        index = self.lexicon_rules[offset]
+        base = rule_base[index]
+        p = rule_prob[index]
+        if p > cell_best.get(base, 0.0):
+          cell_best[base] = p
+          chart[i-1][i][base] = (index, None)
+
+    # Fill in other rows
+    for l in range(2, n + 1):
+      for i in range(0, n-l+1):
+        j = i + l
+        cell = chart[i][j]
+        cell_best = best[i][j]
+        for k in range(i+1, j):
+          right_best = best[k][j]
+          if not right_best:
+            continue
+          for Y, y_prob in best[i][k].items():
+            for pair in range(left_offsets[Y], left_offsets[Y+1]):
+              Z = pair_right[pair]
+              if Z not in right_best:
+                continue
+              z_prob = right_best[Z]
+              for offset in range(pair_offsets[pair], pair_offsets[pair+1]):
+                index = pair_rules[offset]
+                base = rule_base[index]
+                p_prime = rule_prob[index] * y_prob * z_prob
+                current = cell_best.get(base, 0.0)
+                if p_prime > current or (p_prime == current and p_prime > 0.0
+                    and cell[base][1] == k and index < cell[base][0]):
+                  cell_best[base] = p_prime
+                  cell[base] = (index, k)
+
+    if self.top is None or self.top not in chart[0][n]:
+      return None
+
+    def make_tree(i, j, symbol):
+      index, k = chart[i][j][symbol]
+      ###################################################
+      # Remove Vertical Markovization and latent subcategories
+      label = self.string(rule_base[index]).split("[")[0]
+      if k is None:
+        return "(" + label + " " + self.string(self.rule_first[index]) + ")"
+      left_tree = make_tree(i, k, self.rule_first[index])
+      right_tree = make_tree(k, j, self.rule_second[index])
+      return "(" + label + " " + left_tree + " " + right_tree + ")"
+      ###################################################
+
+    return make_tree(0, n, self.top)
+
+class _StringTable(object):
+  """ The sorted string table of a compiled grammar as a sequence of bytes,
+  for bisect
+  """
+  def __init__(self, grammar):
+    self.grammar = grammar
+
+  def __len__(self):
+    return self.grammar.num_strings
+
+  def __getitem__(self, i):
+    offsets = self.grammar.string_offsets
+    return bytes(self.grammar.string_blob[offsets[i]:offsets[i+1]])
+
+def main():
+  import argparse
+  from main import CFG
+
+  argparser = argparse.ArgumentParser()
+  argparser.add_argument('treebank', nargs='?', default='train.trees.pre.unk', help='preprocessed training trees')
+  argparser.add_argument('--output', default='grammar', help='prefix of the compiled grammar files')
+  args = argparser.parse_args()
+
+  cfg = CFG()
+  no_markovization = CFG()
+  cfg.train(args.treebank)
+  no_markovization.train(args.treebank, False)
+
+  compile_grammar(cfg, args.output + ".bin")
+  compile_grammar(no_markovization, args.output + ".nomarkov.bin")
+  sys.stderr.write("wrote " + args.output + ".bin (" + str(len(cfg)) + " rules) and "
+      + args.output + ".nomarkov.bin (" + str(len(no_markovization)) + " rules)\n")
+
+if __name__ == "__main__":
+  main()
@@ -1,54 +1,208 @@
 #!/usr/bin/env python
 
+""" Bracket scoring of parses against gold trees.
+
+usage: evalb.py <parse-file>... <gold-file> [--workers N] [--bucket N] [--sentences]
+
+Can also be imported: score_files() scores several parse files against one
+gold file, reading the gold brackets only once.
+"""
+
 import sys
 import collections
+import forkpool
 import tree
 from six import iteritems, itervalues
 from six.moves import zip
 
-try:
-    _, parsefilename, goldfilename = sys.argv
-except:
-    sys.stderr.write("usage: evalb.py <parse-file> <gold-file>\n")
-    sys.exit(1)
-
 def _brackets_helper(node, i, result):
-    i0 = i
-    if len(node.children) > 0:
-        for child in node.children:
-            i = _brackets_helper(child, i, result)
-        j0 = i
-        if len(node.children[0].children) > 0: # don't count preterminals
-            result[node.label, i0, j0] += 1
-    else:
-        j0 = i0 + 1
-    return j0
+    """ Adds the brackets of the subtree at node, whose first leaf is at
+    position i, to result. Returns the position after its last leaf. """
+    # Each stack entry is a node and its first leaf position, plus the index
+    # of its next child to visit
+    stack = [(node, i, 0)]
+    while stack:
+        (node, i0, c) = stack.pop()
+        if c == 0 and len(node.children) == 0:
+            i = i0 + 1
+        elif c < len(node.children):
+            stack.append((node, i0, c+1))
+            stack.append((node.children[c], i, 0))
+            continue
+        elif len(node.children[0].children) > 0: # don't count preterminals
+            result[node.label, i0, i] += 1
+    return i
 
 def brackets(t):
     result = collections.defaultdict(int)
     _brackets_helper(t.root, 0, result)
     return result
 
-matchcount = parsecount = goldcount = 0
+def brackets_from_str(s):
+    """ Returns the brackets of the tree that tree.Tree.from_str would read
+    from s, along with its number of leaves, without building the tree.
+    Raises ValueError if s has no tree. """
+    s = s.strip()
+    result = collections.defaultdict(int)
+    pos = 0
+    i = 0
+    # Each stack entry is [label, first leaf position, number of children,
+    # whether the first child is an interior node]
+    stack = []
+    while True:
+        match = tree.Tree.interior_node.match(s, pos)
+        if match != None:
+            if stack:
+                if stack[-1][2] == 0:
+                    stack[-1][3] = True
+                stack[-1][2] += 1
+            stack.append([match.group(1), i, 0, False])
+            pos = match.end()
+            continue
+        match = tree.Tree.leaf_node.match(s, pos)
+        if match != None:
+            pos = match.end()
+            i += 1
+            if stack:
+                stack[-1][2] += 1
+        elif stack:
+            match = tree.Tree.close_brace.match(s, pos)
+            if match == None:
+                raise ValueError("no tree in: " + s)
+            pos = match.end()
+            (label, i0, children, interior_first) = stack.pop()
+            if children == 0:
+                # A node without children counts as a leaf
+                i += 1
+            elif interior_first:
+                result[label, i0, i] += 1
+        else:
+            raise ValueError("no tree in: " + s)
+        if not stack:
+            return result, i
+
+class Score(object):
+    """ Bracket counts, for a sentence or a whole file """
+    def __init__(self, match=0, parse=0, gold=0):
+        self.match = match
+        self.parse = parse
+        self.gold = gold
 
-for parseline, goldline in zip(open(parsefilename), open(goldfilename)):
-    gold = tree.Tree.from_str(goldline)
-    goldbrackets = brackets(gold)
-    goldcount += sum(itervalues(goldbrackets))
+    def __iadd__(self, other):
+        self.match += other.match
+        self.parse += other.parse
+        self.gold += other.gold
+        return self
 
+    def precision(self):
+        return float(self.match) / self.parse if self.parse else 0.
+
+    def recall(self):
+        return float(self.match) / self.gold if self.gold else 0.
+
+    def f1(self):
+        if self.match == 0:
+            return 0.
+        return 2./(self.gold/float(self.match) + self.parse/float(self.match))
+
+def score_sentence(parseline, gold):
+    """ Scores one parse line against the (brackets, length) of its gold tree """
     if parseline.strip() in ["0", ""]:
-        continue
-    
-    parse = tree.Tree.from_str(parseline)
-    parsebrackets = brackets(parse)
-    parsecount += sum(itervalues(parsebrackets))
+        return score_brackets(None, gold)
+    parsebrackets, _ = brackets_from_str(parseline)
+    return score_brackets(parsebrackets, gold)
 
+def score_brackets(parsebrackets, gold):
+    """ Scores the brackets of a parse, or None if there is no parse,
+    against the (brackets, length) of its gold tree """
+    goldbrackets, length = gold
+    score = Score(gold=sum(itervalues(goldbrackets)))
+    if parsebrackets is None:
+        return score
+
+    score.parse = sum(itervalues(parsebrackets))
     for bracket,count in iteritems(parsebrackets):
-        matchcount += min(count,goldbrackets[bracket])
-
-print("%s\t%d brackets" % (parsefilename, parsecount))
-print("%s\t%d brackets" % (goldfilename, goldcount))
-print("matching\t%d brackets" % matchcount)
-print("precision\t%s" % (float(matchcount)/parsecount))
-print("recall\t%s" % (float(matchcount)/goldcount))
-print("F1\t%s" % (2./(goldcount/float(matchcount) + parsecount/float(matchcount))))
+        score.match += min(count,goldbrackets.get(bracket, 0))
+    return score
+
+def _score_range(bounds):
+    parselines, gold = forkpool.shared()
+    start, end = bounds
+    return [score_sentence(parselines[n], gold[n]) for n in range(start, end)]
+
+def read_gold(goldfilename):
+    """ Returns the (brackets, length) of every tree in a gold file """
+    with open(goldfilename) as goldfile:
+        return [brackets_from_str(line) for line in goldfile]
+
+def score_lines(parselines, gold, workers=1):
+    """ Returns a Score for every sentence. Parse lines past the end of the
+    gold trees, or gold trees past the end of the parses, are ignored. """
+    n = min(len(parselines), len(gold))
+    if workers <= 1:
+        return [score_sentence(parselines[i], gold[i]) for i in range(n)]
+    return sum(forkpool.fork_map(_score_range, forkpool.shards(n, workers), workers,
+        (parselines, gold)), [])
+
+def score_files(parsefilenames, goldfilename, workers=1):
+    """ Returns a list of per-sentence Scores for each parse file, and the
+    gold sentence lengths """
+    gold = read_gold(goldfilename)
+    results = []
+    for parsefilename in parsefilenames:
+        with open(parsefilename) as parsefile:
+            results.append(score_lines(parsefile.readlines(), gold, workers))
+    return results, [length for (_, length) in gold]
+
+def by_length(scores, lengths, width):
+    """ Sums sentence Scores into buckets of sentence lengths width wide,
+    returning a sorted list of (first length in bucket, sentences, Score) """
+    buckets = collections.OrderedDict()
+    for score, length in zip(scores, lengths):
+        bucket = (length - 1) // width * width + 1
+        if bucket not in buckets:
+            buckets[bucket] = [0, Score()]
+        buckets[bucket][0] += 1
+        buckets[bucket][1] += score
+    return [(bucket, count, score) for bucket, (count, score) in sorted(buckets.items())]
+
+def main():
+    import argparse
+
+    argparser = argparse.ArgumentParser(usage="evalb.py <parse-file>... <gold-file>")
+    argparser.add_argument('files', nargs='+', help='parse files followed by the gold file')
+    argparser.add_argument('--workers', type=int, default=1, help='number of processes')
+    argparser.add_argument('--bucket', type=int, default=None, help='also report scores by sentence length, in buckets this wide')
+    argparser.add_argument('--sentences', action='store_true', help='also report the F1 of every sentence')
+    args = argparser.parse_args()
+    if len(args.files) < 2:
+        sys.stderr.write("usage: evalb.py <parse-file>... <gold-file>\n")
+        sys.exit(1)
+    parsefilenames, goldfilename = args.files[:-1], args.files[-1]
+
+    results, lengths = score_files(parsefilenames, goldfilename, args.workers)
+    for parsefilename, scores in zip(parsefilenames, results):
+        total = Score()
+        for score in scores:
+            total += score
+
+        print("%s\t%d brackets" % (parsefilename, total.parse))
+        print("%s\t%d brackets" % (goldfilename, total.gold))
+        print("matching\t%d brackets" % total.match)
+        print("precision\t%s" % total.precision())
+        print("recall\t%s" % total.recall())
+        print("F1\t%s" % total.f1())
+
+        if args.bucket is not None:
+            print("length\tsentences\tprecision\trecall\tF1")
+            for (bucket, count, score) in by_length(scores, lengths, args.bucket):
+                print("%d-%d\t%d\t%.4f\t%.4f\t%.4f" % (bucket, bucket + args.bucket - 1, count,
+                    score.precision(), score.recall(), score.f1()))
+
+        if args.sentences:
+            print("sentence\tlength\tF1")
+            for (n, (score, length)) in enumerate(zip(scores, lengths)):
+                print("%d\t%d\t%.4f" % (n+1, length, score.f1()))
+
+if __name__ == "__main__":
+    main()
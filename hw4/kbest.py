@@ -0,0 +1,140 @@
+import heapq
+
+class KBestParser(object):
+  """ k-best parsing over a trained CFG, with the lazy enumeration of
+  Huang and Chiang (2005), Algorithm 3.
+
+  One pass of CKY in log space keeps every way of building every item, as
+  a hypergraph, with the best score of each item. Derivations are then
+  enumerated best first, and the next best derivation of an item is only
+  worked out when something above it asks for it. Getting k parses costs
+  about as much as the 1-best pass plus O(k log k) per item used.
+  """
+  def __init__(self, cfg):
+    self.cfg = cfg
+
+  def parse(self, string, k):
+    """ Returns up to k (tree string, log-probability) pairs for a string,
+    best first
+    """
+    cfg = self.cfg
+    words = string.strip().split(" ")
+    n = len(words)
+
+    # incoming[i, j][label] is a list of hyperedges (rule, index, split,
+    # left child, right child) that build label over (i, j). Children are
+    # (i, j, label) items; lexical edges have neither split nor children.
+    incoming = dict(((i, j), {}) for i in range(n) for j in range(i+1, n+1))
+    best = dict(((i, j), {}) for i in range(n) for j in range(i+1, n+1))
+    self._logp = {}
+
+    # Do top row
+    for i in range(1, n+1):
+      word = words[i-1]
+      if word not in cfg.words_seen:
+        word = "<unk>"
+      cell = incoming[i-1, i]
+      cell_best = best[i-1, i]
+      for rule, p, logp in cfg.lexicon.get(word, ()):
+        cell.setdefault(rule.base, []).append((rule, None, None, None, None))
+        self._logp[rule] = logp
+        if rule.base not in cell_best or logp > cell_best[rule.base]:
+          cell_best[rule.base] = logp
+
+    # Fill in other rows
+    for l in range(2, n + 1):
+      for i in range(0, n-l+1):
+        j = i + l
+        cell = incoming[i, j]
+        cell_best = best[i, j]
+        for split in range(i+1, j):
+          for Y, Z, entries in cfg._pairs(best[i, split], best[split, j]):
+            children = best[i, split][Y] + best[split, j][Z]
+            for index, rule, p, logp in entries:
+              cell.setdefault(rule.base, []).append((rule, index, split, (i, split, Y), (split, j, Z)))
+              self._logp[rule] = logp
+              score = logp + children
+              if rule.base not in cell_best or score > cell_best[rule.base]:
+                cell_best[rule.base] = score
+
+    if 'TOP' not in best[0, n]:
+      return []
+
+    self._incoming = incoming
+    self._derivations = {}  # item -> derivations found so far, best first
+    self._candidates = {}   # item -> heap of candidate derivations
+    self._seen = {}         # item -> (edge, ranks) already queued
+
+    top = (0, n, 'TOP')
+    results = []
+    for rank in range(k):
+      derivation = self._kth(top, rank)
+      if derivation is None:
+        break
+      results.append((self._tree(top, rank), derivation[0]))
+    return results
+
+  def _edge_score(self, edge, ranks):
+    """ Score of an edge applied to the ranks[0]-th and ranks[1]-th best
+    derivations of its children, or None if one of them does not exist
+    """
+    rule, index, k, left, right = edge
+    score = self._logp[rule]
+    for child, rank in ((left, ranks[0]), (right, ranks[1])):
+      if child is None:
+        continue
+      derivation = self._kth(child, rank)
+      if derivation is None:
+        return None
+      score += derivation[0]
+    return score
+
+  def _push(self, item, edge_id, ranks):
+    if (edge_id, ranks) in self._seen[item]:
+      return
+    self._seen[item].add((edge_id, ranks))
+    edge = self._incoming[item[0], item[1]][item[2]][edge_id]
+    score = self._edge_score(edge, ranks)
+    if score is not None:
+      # Equal scores go to the earliest split, then the earliest rule
+      split = edge[2] if edge[2] is not None else -1
+      index = edge[1] if edge[1] is not None else -1
+      heapq.heappush(self._candidates[item], (-score, split, index, ranks, edge_id))
+
+  def _kth(self, item, rank):
+    """ Returns the rank-th best derivation of item as (score, edge ID,
+    ranks of the children's derivations), or None if it has fewer
+    """
+    derivations = self._derivations.get(item)
+    if derivations is None:
+      derivations = self._derivations[item] = []
+      self._candidates[item] = []
+      self._seen[item] = set()
+      for edge_id in range(len(self._incoming[item[0], item[1]][item[2]])):
+        self._push(item, edge_id, (0, 0))
+
+    while len(derivations) <= rank:
+      if derivations:
+        # Queue the neighbours of the last derivation taken
+        score, edge_id, ranks = derivations[-1]
+        edge = self._incoming[item[0], item[1]][item[2]][edge_id]
+        if edge[3] is not None:
+          self._push(item, edge_id, (ranks[0] + 1, ranks[1]))
+          self._push(item, edge_id, (ranks[0], ranks[1] + 1))
+      candidates = self._candidates[item]
+      if not candidates:
+        return None
+      score, split, index, ranks, edge_id = heapq.heappop(candidates)
+      derivations.append((-score, edge_id, ranks))
+    return derivations[rank]
+
+  def _tree(self, item, rank):
+    score, edge_id, ranks = self._derivations[item][rank]
+    rule, index, k, left, right = self._incoming[item[0], item[1]][item[2]][edge_id]
+    ###################################################
+    # Remove Vertical Markovization and latent subcategories
+    label = rule.base.split("[")[0]
+    if left is None:
+      return "(" + label + " " + rule.goes_to[0] + ")"
+    return "(" + label + " " + self._tree(left, ranks[0]) + " " + self._tree(right, ranks[1]) + ")"
+    ###################################################
@@ -0,0 +1,295 @@
+#!/usr/bin/env python
+
+""" Refines a trained CFG with latent subcategories.
+
+usage: latent.py [treebank] [--subcategories K] [--iterations N] [--workers N]
+                 [--output PREFIX] [--strings FILE --gold FILE]
+
+Every label but TOP is split into K subcategories, X[sub=0] ... X[sub=K-1],
+as in Matsuzaki et al. (2005). Rule probabilities over the subcategories
+start from the relative frequencies of the CFG, with a little noise to
+break the symmetry, and are re-estimated by EM on the training trees.
+Since the trees are observed, the inside and outside passes only run over
+their nodes, with the scores of all subcategories of a node computed at
+once as numpy arrays.
+
+The refined grammar is an ordinary CFG, so CFG.cky parses with it; the
+subcategories are stripped from the trees it returns. --output compiles it
+for main.py --grammar.
+"""
+
+from main import CFG, Parser, Rule, UNK_COUNT
+from tree import Tree
+
+import argparse
+import forkpool
+import math
+import sys
+import time
+
+import numpy as np
+
+def read_trees(filename, use_vertical_markov=True):
+  """ Yields the trees of a treebank, with their labels annotated the way
+  CFG.train annotates them
+  """
+  with open(filename) as treeFile:
+    for tree in Tree.from_file(treeFile):
+      for node in tree.bottomup():
+        if len(node.children) > 0 and use_vertical_markov and node.parent is not None:
+          node.label += "[parent=" + node.parent.label + "]"
+      yield tree
+
+class LatentGrammar(object):
+  """ Rule probabilities over latent subcategories of the labels of a CFG.
+
+  params[r] holds the probabilities of every split of the r-th rule of
+  cfg.rules: an array indexed by the subcategory of its base, then those
+  of its children that are labels.
+  """
+  def __init__(self, cfg, subcategories=2, seed=0):
+    self.cfg = cfg
+    self.rules = list(cfg.rules)
+    self.rule_ids = dict((rule, r) for r, rule in enumerate(self.rules))
+    self.size = dict((base, 1 if base == 'TOP' else subcategories) for base in cfg.bases)
+    self.by_base = {}
+    for r, rule in enumerate(self.rules):
+      self.by_base.setdefault(rule.base, []).append(r)
+
+    # Pseudo-counts added in every M-step: the X -> <unk> smoothing of
+    # CFG.train, shared evenly by the subcategories of X
+    self.prior = {}
+    for r, rule in enumerate(self.rules):
+      if rule.goes_to == ["<unk>"]:
+        self.prior[r] = float(UNK_COUNT) / self.size[rule.base]
+
+    table = cfg.probability_table()
+    random = np.random.RandomState(seed)
+    self.params = []
+    for rule in self.rules:
+      shape = self.shape(rule)
+      split = float(np.prod(shape[1:])) if len(shape) > 1 else 1.0
+      noise = 1 + 0.01 * (random.random_sample(shape) - 0.5)
+      self.params.append(table[rule] / split * noise)
+    self._normalize(self.params)
+    self.counts = None
+
+  def shape(self, rule):
+    """ Returns the shape of the parameters of a rule
+    """
+    return tuple([self.size[rule.base]] + [self.size[child] for child in rule.goes_to if child in self.size])
+
+  def _normalize(self, arrays):
+    """ Scales arrays in place so that, for every subcategory of every
+    label, the probabilities of its rules sum to one
+    """
+    for base, rule_ids in self.by_base.items():
+      total = np.zeros(self.size[base])
+      for r in rule_ids:
+        total += arrays[r].reshape(self.size[base], -1).sum(axis=1)
+      total[total == 0] = 1.0
+      for r in rule_ids:
+        arrays[r] /= total.reshape((-1,) + (1,) * (arrays[r].ndim - 1))
+
+  def encode(self, tree):
+    """ Returns the nodes of a tree with children, children first, as
+    (rule ID, left child position, right child position), with None for
+    the positions of a preterminal
+    """
+    nodes = []
+    position = {}
+    for node in tree.bottomup():
+      if len(node.children) == 0:
+        continue
+      r = self.rule_ids[Rule(node.label, [child.label for child in node.children])]
+      if len(node.children) == 2:
+        nodes.append((r, position[id(node.children[0])], position[id(node.children[1])]))
+      else:
+        nodes.append((r, None, None))
+      position[id(node)] = len(nodes) - 1
+    return nodes
+
+  def tree_counts(self, nodes, counts):
+    """ Adds the expected counts of every split rule in one encoded tree to
+    counts, a dict from rule ID to array. Returns the tree's log-likelihood.
+
+    Inside scores are rescaled at every node to keep them in range; the
+    outside scores are kept relative to the tree's probability, so that
+    they give posteriors directly.
+    """
+    params = self.params
+    inside = [None] * len(nodes)
+    scale = [None] * len(nodes)
+    loglik = 0.0
+    for n, (r, left, right) in enumerate(nodes):
+      if left is None:
+        score = params[r]
+      else:
+        score = params[r].dot(inside[right]).dot(inside[left])
+      scale[n] = score.max()
+      inside[n] = score / scale[n]
+      loglik += math.log(scale[n])
+
+    root = len(nodes) - 1
+    total = inside[root].sum()
+    loglik += math.log(total)
+    outside = [None] * len(nodes)
+    outside[root] = np.ones(inside[root].shape) / total
+    for n in range(root, -1, -1):
+      r, left, right = nodes[n]
+      p = params[r]
+      o = outside[n] / scale[n]
+      if left is None:
+        posterior = o * p
+      else:
+        y = inside[left]
+        z = inside[right]
+        by_children = o.dot(p.reshape(len(o), -1)).reshape(p.shape[1:])
+        outside[left] = by_children.dot(z)
+        outside[right] = y.dot(by_children)
+        posterior = o[:, None, None] * p * y[None, :, None] * z[None, None, :]
+      if r in counts:
+        counts[r] += posterior
+      else:
+        counts[r] = posterior.copy()
+    return loglik
+
+  def m_step(self, counts):
+    """ Re-estimates the parameters from merged expected counts
+    """
+    self.counts = []
+    for r, p in enumerate(self.params):
+      count = counts[r].copy() if r in counts else np.zeros(p.shape)
+      count += self.prior.get(r, 0.0)
+      self.counts.append(count)
+    self.params = [count.copy() for count in self.counts]
+    self._normalize(self.params)
+
+  def log_prior(self):
+    """ Returns the log of the Dirichlet prior, up to a constant, that the
+    pseudo-counts of m_step stand for, at the current parameters. EM
+    maximizes the log-likelihood plus this, not the log-likelihood alone.
+    """
+    return sum(count * float(np.log(self.params[r]).sum()) for r, count in self.prior.items())
+
+  def name(self, label, subcategory):
+    if self.size.get(label, 1) == 1:
+      return label
+    return label + "[sub=" + str(subcategory) + "]"
+
+  def to_cfg(self, min_count=1e-3):
+    """ Returns the refined grammar as a CFG whose rule counts are the
+    expected counts of the last M-step. Split rules expected fewer than
+    min_count times are left out.
+    """
+    refined = CFG()
+    refined.words_seen = set(self.cfg.words_seen)
+    for rule, count in zip(self.rules, self.counts):
+      labels = [rule.base] + [child for child in rule.goes_to if child in self.size]
+      for index in np.ndindex(*count.shape):
+        if count[index] < min_count:
+          continue
+        names = [self.name(label, a) for label, a in zip(labels, index)]
+        if len(rule.goes_to) == 2:
+          split = Rule(names[0], names[1:])
+        else:
+          split = Rule(names[0], list(rule.goes_to))
+        split.times_seen = float(count[index])
+        refined.add_rule(split)
+    return refined
+
+def _expected_counts_range(bounds):
+  grammar, trees = forkpool.shared()
+  start, end = bounds
+  counts = {}
+  loglik = 0.0
+  for n in range(start, end):
+    loglik += grammar.tree_counts(trees[n], counts)
+  return counts, loglik
+
+def expected_counts(grammar, trees, workers=1):
+  """ Runs the E-step over encoded trees, split into one shard per worker,
+  and returns the merged expected counts and the total log-likelihood
+  """
+  shards = forkpool.fork_map(_expected_counts_range, forkpool.shards(len(trees), workers),
+      workers, (grammar, trees))
+
+  counts = {}
+  loglik = 0.0
+  for shard_counts, shard_loglik in shards:
+    loglik += shard_loglik
+    for r, count in shard_counts.items():
+      if r in counts:
+        counts[r] += count
+      else:
+        counts[r] = count
+  return counts, loglik
+
+def train(cfg, treebank, subcategories=2, iterations=5, workers=1, seed=0, log=sys.stderr):
+  """ Returns the LatentGrammar of a CFG trained on treebank after some
+  iterations of EM. Each iteration logs the objective EM climbs, the
+  log-likelihood of the trees plus the log prior of the pseudo-counts,
+  and the log-likelihood itself, which need not increase.
+  """
+  grammar = LatentGrammar(cfg, subcategories, seed)
+  trees = [grammar.encode(tree) for tree in read_trees(treebank)]
+  for iteration in range(iterations):
+    start = time.time()
+    counts, loglik = expected_counts(grammar, trees, workers)
+    objective = loglik + grammar.log_prior()
+    grammar.m_step(counts)
+    if log is not None:
+      log.write("iteration " + str(iteration + 1) + ": objective " + str(round(objective, 2))
+          + ", log-likelihood " + str(round(loglik, 2))
+          + " (" + str(round(time.time() - start, 2)) + "s)\n")
+  return grammar
+
+def main():
+  argparser = argparse.ArgumentParser()
+  argparser.add_argument('treebank', nargs='?', default='train.trees.pre.unk', help='preprocessed training trees')
+  argparser.add_argument('--subcategories', type=int, default=2, help='subcategories per label')
+  argparser.add_argument('--iterations', type=int, default=20, help='EM iterations')
+  argparser.add_argument('--workers', type=int, default=1, help='processes for the E-step')
+  argparser.add_argument('--seed', type=int, default=0, help='seed for the initial noise')
+  argparser.add_argument('--output', default=None, help='prefix of compiled grammar files to write')
+  argparser.add_argument('--strings', default=None, help='also parse this file and report F1')
+  argparser.add_argument('--gold', default=None, help='gold trees for --strings')
+  args = argparser.parse_args()
+
+  cfg = CFG()
+  no_markovization = CFG()
+  cfg.train(args.treebank)
+  no_markovization.train(args.treebank, False)
+
+  start = time.time()
+  grammar = train(cfg, args.treebank, args.subcategories, args.iterations, args.workers, args.seed)
+  refined = grammar.to_cfg()
+  sys.stderr.write("refined " + str(len(cfg)) + " rules into " + str(len(refined)) + " in "
+      + str(round(time.time() - start, 2)) + "s\n")
+
+  if args.output is not None:
+    from compiled import compile_grammar
+    compile_grammar(refined, args.output + ".bin")
+    compile_grammar(no_markovization, args.output + ".nomarkov.bin")
+
+  if args.strings is not None:
+    import evalb
+    from postprocess import postprocess
+
+    with open(args.strings) as stringFile:
+      lines = stringFile.readlines()
+    for name, trained in [("unrefined", cfg), ("refined", refined)]:
+      parser = Parser(trained, no_markovization)
+      start = time.time()
+      parses = [postprocess(parser.parse(line)[0]) for line in lines]
+      elapsed = time.time() - start
+      if args.gold is not None:
+        total = evalb.Score()
+        for score in evalb.score_lines(parses, evalb.read_gold(args.gold)):
+          total += score
+        print(name + "\t" + str(len(trained)) + " rules\t" + str(round(elapsed, 3)) + "s\tF1 " + str(total.f1()))
+      else:
+        print(name + "\t" + str(len(trained)) + " rules\t" + str(round(elapsed, 3)) + "s")
+
+if __name__ == "__main__":
+  main()
@@ -1,23 +1,74 @@
 from tree import Tree, Node
 from collections import defaultdict
 
+import forkpool
 import itertools
+import json
 import math
 import sys
+import time
+
+# Times X -> <unk> is added for every base X when training
+UNK_COUNT = 30
 
 class CFG(object):
   def __init__(self):
     self._rules = defaultdict(list)
     self.words_seen = set()
 
+    # Rules by (base ID, child IDs), with every symbol interned to an int
+    self._rule_keys = {}
+    self.symbols = []
+    self.symbol_ids = {}
+
+    # Normalizers for conditional_probability, kept up to date by add_rule
+    self._totals = defaultdict(int)
+    self._num_rules = 0
+
+    # Indexed form of the grammar, built by finalize()
+    self._frozen = False
+    self._probabilities = {}
+    self._vectorized = None
+    self._agenda = None
+    self.lexicon = {}
+    self.binary_by_left = {}
+    self.binary_by_pair = {}
+
+    # Grammar without vertical markovization used by cky_coarse_to_fine
+    self.coarse = None
+
+    # If set, cky and cky_log count the rule applications of their last
+    # chart into self.edges and self.chart_stats; otherwise they count
+    # nothing
+    self.instrument = False
+    self.chart_stats = None
+
+    # Whether the last call to cky ran out of time before finishing its chart
+    self.timed_out = False
+
+  def intern(self, symbol):
+    """ Returns the int ID of a symbol, giving it one if it is new
+    """
+    symbol_id = self.symbol_ids.get(symbol)
+    if symbol_id is None:
+      symbol_id = self.symbol_ids[symbol] = len(self.symbols)
+      self.symbols.append(symbol)
+    return symbol_id
+
   def add_rule(self, rule):
-    if rule not in self._rules[rule.base]:
+    self._frozen = False
+    key = (self.intern(rule.base), tuple([self.intern(token) for token in rule.goes_to]))
+    seen = self._rule_keys.get(key)
+    if seen is None:
       # Rule not seen yet
+      self._rule_keys[key] = rule
       self._rules[rule.base].append(rule)
+      self._num_rules += 1
+      self._totals[rule.base] += rule.times_seen
     else:
       # Rule seen already, add to count
-      index = self._rules[rule.base].index(rule)
-      self._rules[rule.base][index].times_seen += 1
+      seen.times_seen += 1
+      self._totals[rule.base] += 1
 
   @property
   def rules(self):
@@ -25,13 +76,11 @@ class CFG(object):
 
   @property
   def bases(self):
-    return set([rule.base for rule in self.rules])
+    return set(self._rules)
 
   def train(self, filename, use_vertical_markov=True):
     with open(filename) as treeFile:
-      lines = treeFile.readlines()
-      for line in lines:
-        tree = Tree.from_str(line)
+      for tree in Tree.from_file(treeFile):
         for node in tree.bottomup():
           if len(node.children) > 0:
 
@@ -53,50 +102,185 @@ class CFG(object):
     # Add smoothing: by adding X-><unk> for every base
     for base in self.bases:
       unk_rule = Rule(base, ["<unk>"])
-      for i in range(30):
+      for i in range(UNK_COUNT):
         self.add_rule(unk_rule)
     #################################################
-      
-  def cky(self, string):
-    """ Finds the highest probability parse of a given string
+
+  def compact(self, min_count=1, min_probability=0.0, merge_below=0):
+    """ Returns a smaller copy of the grammar. Parent-annotated labels
+    X[parent=Y] seen fewer than merge_below times in training are merged
+    back into X, then rules seen fewer than min_count times or with a
+    probability below min_probability are dropped. Words left without a
+    rule are treated as unknown.
+    """
+    table = self.probability_table()
+    merged = {}
+    for base in self._rules:
+      if "[parent" in base and self._totals[base] - UNK_COUNT < merge_below:
+        merged[base] = base.split("[parent")[0]
+
+    counts = {}
+    smoothed = set()
+    for rule in self.rules:
+      if table[rule] < min_probability:
+        continue
+      base = merged.get(rule.base, rule.base)
+      key = (base, tuple([merged.get(token, token) for token in rule.goes_to]))
+      times_seen = rule.times_seen
+      if rule.goes_to == ["<unk>"]:
+        # A label gets the X -> <unk> smoothing once, however many labels
+        # were merged into it
+        if base in smoothed:
+          times_seen -= UNK_COUNT
+        smoothed.add(base)
+      counts[key] = counts.get(key, 0) + times_seen
+
+    compacted = CFG()
+    for (base, goes_to), times_seen in counts.items():
+      if times_seen < min_count or times_seen <= 0:
+        continue
+      rule = Rule(base, list(goes_to))
+      rule.times_seen = times_seen
+      compacted.add_rule(rule)
+      for token in goes_to:
+        if token in self.words_seen:
+          compacted.words_seen.add(token)
+    return compacted
+
+  def finalize(self):
+    """ Computes the probability of every rule and builds the indexed
+    form of the grammar used by cky: a lexicon
+    mapping each word to the rules that produce it and the binary rules
+    indexed by their children. Rules keep their position in self.rules
+    so that ties are broken exactly as a scan over self.rules would.
+    """
+    self._probabilities = {}
+    self._vectorized = None
+    self._agenda = None
+    self.lexicon = defaultdict(list)
+    self.binary_by_left = defaultdict(lambda: defaultdict(list))
+    self.binary_by_pair = {}
+
+    for index, rule in enumerate(self.rules):
+      p = self.conditional_probability(rule)
+      logp = math.log(p)
+      self._probabilities[rule] = p
+      for token in set(rule.goes_to):
+        self.lexicon[token].append((rule, p, logp))
+      if len(rule.goes_to) == 2:
+        Y, Z = rule.goes_to
+        self.binary_by_left[Y][Z].append((index, rule, p, logp))
+
+    for Y, by_right in self.binary_by_left.items():
+      for Z, entries in by_right.items():
+        self.binary_by_pair[Y, Z] = entries
+
+    self.lexicon = dict(self.lexicon)
+    self.binary_by_left = {Y: dict(by_right) for Y, by_right in self.binary_by_left.items()}
+    self._frozen = True
+
+  def probability_table(self):
+    """ Returns a dict mapping every rule to its conditional probability,
+    in the same order as self.rules
     """
+    if not self._frozen:
+      self.finalize()
+    return self._probabilities
+
+  def cky(self, string, deadline=None):
+    """ Finds the highest probability parse of a given string. If the
+    time.time() deadline passes before the chart is full, stops and returns
+    a glue of the best items found so far, and sets self.timed_out.
+    """
+    chart, best, words = self._cky_chart(string, deadline)
+    if self.timed_out:
+      return self._glue(chart, best, words)
+    return self._backtrack(chart, len(words))
+
+  def cky_tree(self, string):
+    """ Like cky, but returns the parse as a tree.Tree, or None
+    """
+    chart, best, words = self._cky_chart(string)
+    n = len(words)
+    if 'TOP' not in chart[0][n]:
+      return None
+    return Tree(self._make_node(chart, *chart[0][n]['TOP']))
+
+  def _cky_chart(self, string, deadline=None):
+    """ Fills the CKY chart of a string, returning the chart of
+    backpointers, the best probability of every entry and the words
+    """
+    if not self._frozen:
+      self.finalize()
+    self.timed_out = False
+
     # Create Chart
     words = string.strip().split(" ")
     n = len(words)
 
     chart = [[dict() for i in range(n+1)] for i in range(n+1)]
-    best = [[defaultdict(float) for i in range(n+1)] for i in range(n+1)]
+    best = [[dict() for i in range(n+1)] for i in range(n+1)]
+    # Rule applications tried and accepted, only counted when instrumented
+    counting = self.instrument
+    edges = 0
+    accepted = 0
 
     # Do top row
     for i in range(1, n+1):
       word = words[i-1]
       if word not in self.words_seen:
         word = "<unk>"
-      for rule in self.rules:
-        if word in rule.goes_to:
-          p = self.conditional_probability(rule)
-          if p > best[i-1][i][rule.base]:
-            best[i-1][i][rule.base] = p
-            chart[i-1][i][rule.base] = [rule, i, None, None]
+      cell_best = best[i-1][i]
+      entries = self.lexicon.get(word, ())
+      if counting:
+        edges += len(entries)
+      for rule, p, logp in entries:
+        if p > cell_best.get(rule.base, 0.0):
+          if counting:
+            accepted += 1
+          cell_best[rule.base] = p
+          chart[i-1][i][rule.base] = [rule, i, None, None]
 
     # Fill in other rows
     for l in range(2, n + 1):
+      if self.timed_out:
+        break
       for i in range(0, n-l+1):
+        if deadline is not None and time.time() >= deadline:
+          self.timed_out = True
+          break
         j = i + l
+        cell = chart[i][j]
+        cell_best = best[i][j]
+        # Position in self.rules of the rule behind each entry, so that an
+        # equal score from an earlier rule at the same split still wins
+        cell_index = {}
         for k in range(i+1, j):
-          binary_rules = filter(lambda x: len(x.goes_to) == 2, self.rules)
-          for rule in binary_rules:
-            Y = rule.goes_to[0]
-            Z = rule.goes_to[1]
-
-            y_set = [base for base in chart[i][k]]
-            z_set = [base for base in chart[k][j]]
-
-            if Y in y_set and Z in z_set:
-              p_prime = self.conditional_probability(rule) * best[i][k][Y] * best[k][j][Z]
-              if p_prime > best[i][j][rule.base]:
-                best[i][j][rule.base] = p_prime
-                chart[i][j][rule.base] = [rule, i, j, k]
+          right_best = best[k][j]
+          if not right_best:
+            continue
+          for Y, y_prob in best[i][k].items():
+            by_right = self.binary_by_left.get(Y)
+            if by_right is None:
+              continue
+            if len(by_right) < len(right_best):
+              pairs = [(Z, entries) for Z, entries in by_right.items() if Z in right_best]
+            else:
+              pairs = [(Z, by_right[Z]) for Z in right_best if Z in by_right]
+            for Z, entries in pairs:
+              z_prob = right_best[Z]
+              if counting:
+                edges += len(entries)
+              for index, rule, p, logp in entries:
+                p_prime = p * y_prob * z_prob
+                current = cell_best.get(rule.base, 0.0)
+                if p_prime > current or (p_prime == current and p_prime > 0.0
+                    and cell[rule.base][3] == k and index < cell_index[rule.base]):
+                  if counting:
+                    accepted += 1
+                  cell_best[rule.base] = p_prime
+                  cell[rule.base] = [rule, i, j, k]
+                  cell_index[rule.base] = index
 
     """
     # print chart
@@ -107,58 +291,377 @@ class CFG(object):
           print("\t" + str(rule))
     """
 
-    def make_tree(chart, rule, i, j, k):
-      if j is not None:
-        left_rule, left_i, left_j, left_k = chart[i][k][rule.goes_to[0]]
-        left_tree = make_tree(chart, left_rule, left_i, left_j, left_k)
-    
-        right_rule, right_i, right_j, right_k = chart[k][j][rule.goes_to[1]]
-        right_tree = make_tree(chart, right_rule, right_i, right_j, right_k)
-
-        ###################################################
-        # Remove Vertical Markovization
-        return "(" + rule.base.split("[parent")[0] + " " + left_tree + " " + right_tree + ")"
-        ###################################################
+    if counting:
+      self.edges = edges
+      self.chart_stats = self._chart_stats(chart, edges, accepted)
+    return chart, best, words
 
-      else:
-        ###################################################
-        # Remove Vertical Markovization
-        return "(" + rule.base.split("[parent")[0] + " " + rule.goes_to[0] + ")"
-        ###################################################
+  def _glue(self, chart, best, words):
+    """ Covers a sentence whose chart was not finished with the best items
+    in it, taking the longest one from the left each time, under a flat TOP
+    """
+    n = len(words)
+    pieces = []
+    i = 0
+    while i < n:
+      for j in range(n, i, -1):
+        labels = [label for label in best[i][j] if label != 'TOP']
+        if labels:
+          break
+      if not labels:
+        # No rule rewrites to this word
+        pieces.append("(X " + words[i] + ")")
+        i += 1
+        continue
+      label = max(labels, key=lambda label: (best[i][j][label], label))
+      pieces.append(self._make_tree(chart, *chart[i][j][label]))
+      i = j
+    return "(TOP " + " ".join(pieces) + ")"
+
+  @staticmethod
+  def _chart_stats(chart, tried, accepted):
+    """ Summarizes a filled chart for instrumentation
+    """
+    cells = sum(1 for row in chart for cell in row if cell)
+    return {"cells": cells, "tried": tried, "accepted": accepted}
 
+  def _backtrack(self, chart, n):
+    """ Builds the tree string for the TOP entry over the whole sentence,
+    or returns None if there is none
+    """
     #print("\n" + string.strip())
     if 'TOP' in chart[0][n]:
       # Parse Exists, backtrack to find full parse
       top_rule, i, j, k = chart[0][n]['TOP']
-      tree = make_tree(chart, top_rule, i, j, k)
+      tree = self._make_tree(chart, top_rule, i, j, k)
       return tree
     else:
       return None
 
+  def _make_tree(self, chart, rule, i, j, k):
+    """ Builds the tree string for a chart entry
+    """
+    if j is not None:
+      left_rule, left_i, left_j, left_k = chart[i][k][rule.goes_to[0]]
+      left_tree = self._make_tree(chart, left_rule, left_i, left_j, left_k)
+  
+      right_rule, right_i, right_j, right_k = chart[k][j][rule.goes_to[1]]
+      right_tree = self._make_tree(chart, right_rule, right_i, right_j, right_k)
+
+      ###################################################
+      # Remove Vertical Markovization and latent subcategories
+      return "(" + rule.base.split("[")[0] + " " + left_tree + " " + right_tree + ")"
+      ###################################################
+
+    else:
+      ###################################################
+      # Remove Vertical Markovization and latent subcategories
+      return "(" + rule.base.split("[")[0] + " " + rule.goes_to[0] + ")"
+      ###################################################
+
+  def _make_node(self, chart, rule, i, j, k):
+    """ Builds the tree.Node for a chart entry
+    """
+    label = rule.base.split("[")[0]
+    if j is None:
+      return Node(label, [Node(rule.goes_to[0], [])])
+    left = self._make_node(chart, *chart[i][k][rule.goes_to[0]])
+    right = self._make_node(chart, *chart[k][j][rule.goes_to[1]])
+    return Node(label, [left, right])
+
+  def cky_log(self, string, beam=None, threshold=None, allowed=None):
+    """ Finds the highest probability parse of a given string, adding
+    log-probabilities so that long sentences do not underflow.
+
+    Once a cell is filled, only its `beam` best entries are kept, and of
+    those only the ones whose log-probability is within `threshold` of the
+    cell's best, a margin in natural-log units. None turns the corresponding limit off. The number of
+    entries pruned from the chart is left in self.pruned.
+
+    If given, allowed[i][j] is the set of labels, without vertical
+    markovization, that may be built over the span (i, j).
+    """
+    if not self._frozen:
+      self.finalize()
+    self.pruned = 0
+
+    # Create Chart
+    words = string.strip().split(" ")
+    n = len(words)
+
+    chart = [[dict() for i in range(n+1)] for i in range(n+1)]
+    best = [[dict() for i in range(n+1)] for i in range(n+1)]
+    # Rule applications tried and accepted, only counted when instrumented
+    counting = self.instrument
+    edges = 0
+    accepted = 0
+
+    # Do top row
+    for i in range(1, n+1):
+      word = words[i-1]
+      if word not in self.words_seen:
+        word = "<unk>"
+      cell_best = best[i-1][i]
+      cell_allowed = allowed[i-1][i] if allowed is not None else None
+      entries = self.lexicon.get(word, ())
+      if cell_allowed is not None:
+        entries = [entry for entry in entries if coarse_label(entry[0].base) in cell_allowed]
+      if counting:
+        edges += len(entries)
+      for rule, p, logp in entries:
+        if rule.base not in cell_best or logp > cell_best[rule.base]:
+          if counting:
+            accepted += 1
+          cell_best[rule.base] = logp
+          chart[i-1][i][rule.base] = [rule, i, None, None]
+      self.pruned += self._prune(chart[i-1][i], cell_best, beam, threshold)
+
+    # Fill in other rows
+    for l in range(2, n + 1):
+      for i in range(0, n-l+1):
+        j = i + l
+        cell = chart[i][j]
+        cell_best = best[i][j]
+        cell_index = {}
+        cell_allowed = allowed[i][j] if allowed is not None else None
+        if cell_allowed is not None and not cell_allowed:
+          continue
+        for k in range(i+1, j):
+          right_best = best[k][j]
+          if not right_best:
+            continue
+          for Y, y_score in best[i][k].items():
+            by_right = self.binary_by_left.get(Y)
+            if by_right is None:
+              continue
+            if len(by_right) < len(right_best):
+              pairs = [(Z, entries) for Z, entries in by_right.items() if Z in right_best]
+            else:
+              pairs = [(Z, by_right[Z]) for Z in right_best if Z in by_right]
+            for Z, entries in pairs:
+              z_score = right_best[Z]
+              if cell_allowed is not None:
+                entries = [entry for entry in entries if coarse_label(entry[1].base) in cell_allowed]
+              if counting:
+                edges += len(entries)
+              for index, rule, p, logp in entries:
+                score = logp + y_score + z_score
+                if rule.base not in cell_best or score > cell_best[rule.base] or (
+                    score == cell_best[rule.base] and cell[rule.base][3] == k
+                    and index < cell_index[rule.base]):
+                  if counting:
+                    accepted += 1
+                  cell_best[rule.base] = score
+                  cell[rule.base] = [rule, i, j, k]
+                  cell_index[rule.base] = index
+        self.pruned += self._prune(cell, cell_best, beam, threshold)
+
+    if counting:
+      self.edges = edges
+      self.chart_stats = self._chart_stats(chart, edges, accepted)
+    return self._backtrack(chart, n)
+
+  def posteriors(self, string):
+    """ Runs inside-outside over a string. Returns a chart where
+    chart[i][j][label] is the posterior probability that label spans (i, j),
+    or None if the string has no parse.
+    """
+    if not self._frozen:
+      self.finalize()
+
+    words = string.strip().split(" ")
+    n = len(words)
+
+    inside = [[dict() for i in range(n+1)] for i in range(n+1)]
+    outside = [[dict() for i in range(n+1)] for i in range(n+1)]
+
+    # Inside pass, bottom-up
+    for i in range(1, n+1):
+      word = words[i-1]
+      if word not in self.words_seen:
+        word = "<unk>"
+      cell = inside[i-1][i]
+      for rule, p, logp in self.lexicon.get(word, ()):
+        cell[rule.base] = log_add(cell.get(rule.base), logp)
+
+    for l in range(2, n + 1):
+      for i in range(0, n-l+1):
+        j = i + l
+        cell = inside[i][j]
+        for k in range(i+1, j):
+          for Y, Z, entries in self._pairs(inside[i][k], inside[k][j]):
+            children = inside[i][k][Y] + inside[k][j][Z]
+            for index, rule, p, logp in entries:
+              cell[rule.base] = log_add(cell.get(rule.base), logp + children)
+
+    if 'TOP' not in inside[0][n]:
+      return None
+    total = inside[0][n]['TOP']
+
+    # Outside pass, top-down, pushing each span's outside score to its children
+    outside[0][n]['TOP'] = 0.0
+    for l in range(n, 1, -1):
+      for i in range(0, n-l+1):
+        j = i + l
+        parents = outside[i][j]
+        if not parents:
+          continue
+        for k in range(i+1, j):
+          left = outside[i][k]
+          right = outside[k][j]
+          for Y, Z, entries in self._pairs(inside[i][k], inside[k][j]):
+            for index, rule, p, logp in entries:
+              if rule.base not in parents:
+                continue
+              score = parents[rule.base] + logp
+              left[Y] = log_add(left.get(Y), score + inside[k][j][Z])
+              right[Z] = log_add(right.get(Z), score + inside[i][k][Y])
+
+    posterior = [[dict() for i in range(n+1)] for i in range(n+1)]
+    for i in range(n):
+      for j in range(i+1, n+1):
+        for label, score in outside[i][j].items():
+          if label in inside[i][j]:
+            posterior[i][j][label] = math.exp(inside[i][j][label] + score - total)
+    return posterior
+
+  def _pairs(self, left_cell, right_cell):
+    """ Yields (Y, Z, binary rules for Y Z) for the labels in two adjacent cells
+    """
+    if not right_cell:
+      return
+    for Y in left_cell:
+      by_right = self.binary_by_left.get(Y)
+      if by_right is None:
+        continue
+      if len(by_right) < len(right_cell):
+        for Z, entries in by_right.items():
+          if Z in right_cell:
+            yield Y, Z, entries
+      else:
+        for Z in right_cell:
+          if Z in by_right:
+            yield Y, Z, by_right[Z]
+
+  def cky_coarse_to_fine(self, string, posterior_threshold=1e-4, beam=None):
+    """ Parses with self.coarse first, then runs cky_log allowing only the
+    spans and labels whose coarse posterior probability, between 0 and 1,
+    is at least `posterior_threshold`. Unlike the threshold of cky_log, it
+    is not a log-probability. Without a coarse grammar this is an
+    exhaustive cky_log.
+    """
+    if self.coarse is None:
+      return self.cky_log(string, beam)
+    posterior = self.coarse.posteriors(string)
+    if posterior is None:
+      self.pruned = 0
+      return None
+    allowed = [[set(label for label, p in cell.items() if p >= posterior_threshold)
+        for cell in row] for row in posterior]
+    return self.cky_log(string, beam, allowed=allowed)
+
+  @staticmethod
+  def _prune(cell, cell_best, beam, threshold):
+    """ Drops all but the best entries of a cell, returning how many were dropped
+    """
+    # With these the best entry is always kept
+    assert beam is None or beam >= 1, "beam must be at least 1"
+    assert threshold is None or threshold >= 0, "threshold must not be negative"
+    if not cell_best or (beam is None and threshold is None):
+      return 0
+    ranked = sorted(cell_best, key=lambda base: cell_best[base], reverse=True)
+    keep = len(ranked) if beam is None else min(beam, len(ranked))
+    if threshold is not None:
+      cutoff = cell_best[ranked[0]] - threshold
+      while cell_best[ranked[keep-1]] < cutoff:
+        keep -= 1
+    for base in ranked[keep:]:
+      del cell[base]
+      del cell_best[base]
+    return len(ranked) - keep
+
+  def cky_numpy(self, string):
+    """ Same as cky, but runs on the numpy engine in vcky.py
+    """
+    if not self._frozen:
+      self.finalize()
+    if self._vectorized is None:
+      from vcky import VectorizedCKY
+      self._vectorized = VectorizedCKY(self)
+    return self._vectorized.cky(string)
+
+  def cky_agenda(self, string, heuristic=True):
+    """ Same as cky, but runs the best-first parser in agenda.py, with an
+    A* outside estimate unless heuristic is False. The number of rule
+    applications it made is left in self.edges.
+    """
+    if not self._frozen:
+      self.finalize()
+    if self._agenda is None:
+      from agenda import AgendaParser
+      self._agenda = AgendaParser(self)
+    tree = self._agenda.parse(string, heuristic)
+    self.edges = self._agenda.edges
+    return tree
+
+  def cky_kbest(self, string, k):
+    """ Returns the k best parses of a string as (tree string,
+    log-probability) pairs, best first. See kbest.py.
+    """
+    if not self._frozen:
+      self.finalize()
+    from kbest import KBestParser
+    return KBestParser(self).parse(string, k)
+
   def conditional_probability(self, rule):
-    rulelist = self._rules[rule.base]
-    total = sum(rule.times_seen  for rule in rulelist)
-    
+    total = self._totals[rule.base]
+
     ###################################################
     # Add Delta Smoothing
     delta = 0.01
-    return (float(rule.times_seen) + delta) / (total + len(list(self.rules)) * delta)
+    return (float(rule.times_seen) + delta) / (total + self._num_rules * delta)
     ###################################################
 
   def __len__(self):  
     """ Returns the number of unique rules
     """
-    return len(list(self.rules))
+    return self._num_rules
 
   def __str__(self):
     s = ""
-    for rulelist in self._rules.values():
-      total = sum(rule.times_seen for rule in rulelist)
+    for base, rulelist in self._rules.items():
       for rule in rulelist:
-        s += rule.string_with_percent(total) + "\n"
+        s += rule.string_with_percent(self._totals[base]) + "\n"
     return s.strip()
 
+def coarse_label(label, _cache={}):
+  """ Strips the vertical markovization and latent subcategories from a label
+  """
+  if label not in _cache:
+    _cache[label] = label.split("[")[0]
+  return _cache[label]
+
+def log_add(a, b):
+  """ Returns log(exp(a) + exp(b)), where a may be None for an empty sum
+  """
+  if a is None:
+    return b
+  if a < b:
+    a, b = b, a
+  return a + math.log1p(math.exp(b - a))
+
+ENGINES = {
+  "agenda": lambda cfg, string: cfg.cky_agenda(string, False),
+  "astar": CFG.cky_agenda,
+  "cky": CFG.cky,
+  "c2f": CFG.cky_coarse_to_fine,
+  "log": CFG.cky_log,
+  "numpy": CFG.cky_numpy,
+}
+
 class Rule(object):
+  __slots__ = ['base', 'goes_to', 'times_seen']
+
   def __init__(self, base, goes_to):
     self.base = base
     self.goes_to = goes_to
@@ -171,10 +674,7 @@ class Rule(object):
     return self.base + " -> " + " ".join(self.goes_to) + " # " + str(self.times_seen)
 
   def __hash__(self):
-    result = hash(self.base)
-    for token in self.goes_to:
-      result ^= hash(token)
-    return result
+    return hash((self.base, tuple(self.goes_to)))
 
   def __eq__(self, other):
     return self.base == other.base and self.goes_to == other.goes_to
@@ -195,10 +695,10 @@ def main():
 
   # Find top 5 most occurring rules by percent
   print("\nTop 5 most occurring rules with percents: ")
-  rules = list(cfg.rules)
-  rules.sort(key = lambda x: cfg.conditional_probability(x), reverse=True)
+  table = cfg.probability_table()
+  rules = sorted(table, key = lambda x: table[x], reverse=True)
   for rule in rules[:5]:
-    print(str(rule).split("#")[0] + "# " + str(cfg.conditional_probability(rule)))
+    print(str(rule).split("#")[0] + "# " + str(table[rule]))
 
   # Run your parser on dev.strings and save the output to dev.parses.
   # Show the output of your parser on the first five lines of dev.strings,
@@ -211,25 +711,184 @@ def main():
       if prob is not None:
         print("probability: " + str(math.log(prob)))
 
+class Parser(object):
+  """ Parses sentences with one of the ENGINES, falling back to a grammar
+  without vertical markovization when the main grammar finds no parse.
+
+  With the cky engine, parsing can be bounded: a sentence gets at most
+  deadline seconds, and one longer than max_length words is not parsed at
+  all. Either way it gets a glue of the best partial analyses instead,
+  which is reported as degraded.
+  """
+  def __init__(self, cfg, no_markovization, engine="cky", beam=None, threshold=None, posterior_threshold=1e-4,
+      trace=False, deadline=None, max_length=None):
+    self.cfg = cfg
+    self.no_markovization = no_markovization
+    self.engine = engine
+    self.beam = beam
+    self.threshold = threshold
+    self.posterior_threshold = posterior_threshold
+    self.trace = trace
+    self.deadline = deadline
+    self.max_length = max_length
+    for grammar in [cfg, no_markovization]:
+      grammar.instrument = trace
+
+  def _parse(self, grammar, line, deadline=None):
+    if deadline is not None:
+      return grammar.cky(line, deadline)
+    if self.engine == "log":
+      return grammar.cky_log(line, self.beam, self.threshold)
+    elif self.engine == "c2f":
+      return grammar.cky_coarse_to_fine(line, self.posterior_threshold, self.beam)
+    elif self.engine == "cky":
+      # Also works for a compiled.CompiledGrammar
+      return grammar.cky(line)
+    return ENGINES[self.engine](grammar, line)
+
+  def parse(self, line):
+    """ Returns the tree string for a line, or "" if neither grammar can
+    parse it, along with the number of chart entries pruned, why the parse
+    was degraded ("length", "deadline" or None) and, if tracing, a dict of
+    statistics about the parse, else None.
+    """
+    start = time.time()
+    length = len(line.strip().split(" "))
+    deadline = None
+    reason = None
+    if self.max_length is not None and length > self.max_length:
+      # Fill in the words only
+      deadline = start
+      reason = "length"
+    elif self.deadline is not None:
+      deadline = start + self.deadline
+      reason = "deadline"
+
+    grammars = [self.cfg]
+    tree_string = self._parse(self.cfg, line, deadline)
+    pruned = getattr(self.cfg, "pruned", 0)
+    if tree_string is None:
+      grammars.append(self.no_markovization)
+      tree_string = self._parse(self.no_markovization, line, deadline)
+      pruned += getattr(self.no_markovization, "pruned", 0)
+
+    degraded = None
+    if getattr(grammars[-1], "timed_out", False):
+      degraded = reason
+
+    record = None
+    if self.trace:
+      record = self._record(length, time.time() - start, grammars, tree_string, degraded)
+    if tree_string is None:
+      tree_string = ""
+    return tree_string, pruned, degraded, record
+
+  def _record(self, length, seconds, grammars, tree_string, degraded):
+    record = {"length": length, "seconds": seconds, "fallback": len(grammars) > 1,
+        "parsed": tree_string is not None, "degraded": degraded}
+
+    # Chart sizes, summed over the grammars used, for the engines that report them
+    for grammar in grammars:
+      stats = getattr(grammar, "chart_stats", None)
+      grammar.chart_stats = None
+      if stats is None:
+        continue
+      for key, value in stats.items():
+        record[key] = record.get(key, 0) + value
+    return record
+
+def _parse_in_worker(line):
+  return forkpool.shared().parse(line)
+
+def parse_lines(parser, lines, workers=1, chunksize=1):
+  """ Yields parser.parse(line) for every line, in input order. With more
+  than one worker the lines are parsed in a pool of forked processes and
+  each result is yielded as soon as it and all earlier ones are done.
+  """
+  if workers <= 1:
+    for line in lines:
+      yield parser.parse(line)
+    return
+
+  # Build the indexes once here rather than once per worker
+  for grammar in [parser.cfg, parser.no_markovization]:
+    grammar.finalize()
+  for result in forkpool.fork_imap(_parse_in_worker, lines, workers, chunksize, parser):
+    yield result
+
 if __name__ == "__main__":
-  #main()
-  cfg = CFG()
-  no_markovization = CFG()
+  import argparse
+
+  argparser = argparse.ArgumentParser()
+  argparser.add_argument('strings', help='file with one sentence per line')
+  argparser.add_argument('--engine', choices=sorted(ENGINES), default='cky', help='CKY implementation to use')
+  argparser.add_argument('--beam', type=int, default=None, help='log engine: entries kept per cell')
+  argparser.add_argument('--threshold', type=float, default=None, help='log engine: max margin below the cell\'s best, in natural-log probability')
+  argparser.add_argument('--posterior-threshold', '--posterior', type=float, default=1e-4, help='c2f engine: min coarse posterior probability (0 to 1) of a span and label')
+  argparser.add_argument('--workers', type=int, default=1, help='number of parser processes')
+  argparser.add_argument('--chunksize', type=int, default=1, help='sentences handed to a worker at a time')
+  argparser.add_argument('--grammar', default=None, help='prefix of grammar files written by compiled.py, instead of training')
+  argparser.add_argument('--trace', default=None, help='write per-sentence statistics to this file as JSON lines')
+  argparser.add_argument('--deadline', type=float, default=None, help='cky engine: seconds per sentence before giving a partial parse')
+  argparser.add_argument('--max-length', type=int, default=None, help='cky engine: longest sentence to parse; longer ones get a partial parse')
+  argparser.add_argument('--min-count', type=int, default=1, help='drop rules seen fewer times (see compact.py)')
+  argparser.add_argument('--min-probability', type=float, default=0.0, help='drop rules less likely')
+  argparser.add_argument('--merge-below', type=int, default=0, help='merge parent-annotated labels seen fewer times')
+  args = argparser.parse_args()
+  if args.grammar is not None and args.engine != "cky":
+    argparser.error("--grammar only supports --engine cky")
+  if args.beam is not None and args.beam < 1:
+    argparser.error("--beam must be at least 1")
+  if args.threshold is not None and args.threshold < 0:
+    argparser.error("--threshold must not be negative")
+  if (args.deadline is not None or args.max_length is not None) and (args.engine != "cky" or args.grammar is not None):
+    argparser.error("--deadline and --max-length only support --engine cky with a trained grammar")
 
-  cfg.train("train.trees.pre.unk")
-  no_markovization.train("train.trees.pre.unk", False)
+  #main()
+  if args.grammar is not None:
+    from compiled import CompiledGrammar
+    cfg = CompiledGrammar(args.grammar + ".bin")
+    no_markovization = CompiledGrammar(args.grammar + ".nomarkov.bin")
+  else:
+    cfg = CFG()
+    no_markovization = CFG()
+
+    cfg.train("train.trees.pre.unk")
+    no_markovization.train("train.trees.pre.unk", False)
+    if args.min_count > 1 or args.min_probability > 0.0 or args.merge_below > 0:
+      cfg = cfg.compact(args.min_count, args.min_probability, args.merge_below)
+      no_markovization = no_markovization.compact(args.min_count, args.min_probability)
+    cfg.coarse = no_markovization
+
+  parser = Parser(cfg, no_markovization, args.engine, args.beam, args.threshold, args.posterior_threshold,
+      args.trace is not None, args.deadline, args.max_length)
+  traceFile = open(args.trace, "w") if args.trace is not None else None
+  pruned = 0
+  degraded = defaultdict(int)
 
   #print("\nCKY Parses of all lines in devFile")
-  with open(sys.argv[1]) as devFile:
+  with open(args.strings) as devFile:
     lines = devFile.readlines()
     #lines = devFile.readlines()[37:38]
-    for line in lines:
-      tree_string = cfg.cky(line)
-      if tree_string is not None:
-        print(tree_string)
-      else:
-        tree_string_without_markovization = no_markovization.cky(line)
-        if tree_string_without_markovization is not None:
-          print(tree_string_without_markovization)
-        else:
-          print("")
+
+  start = time.time()
+  for n, (tree_string, line_pruned, reason, record) in enumerate(parse_lines(parser, lines, args.workers, args.chunksize)):
+    pruned += line_pruned
+    if reason is not None:
+      degraded[reason] += 1
+    print(tree_string)
+    sys.stdout.flush()
+    if traceFile is not None:
+      record["sentence"] = n + 1
+      traceFile.write(json.dumps(record, sort_keys=True) + "\n")
+  elapsed = time.time() - start
+  if traceFile is not None:
+    traceFile.close()
+
+  sys.stderr.write("parsed " + str(len(lines)) + " sentences in " + str(round(elapsed, 3)) + "s ("
+      + str(round(len(lines) / max(elapsed, 1e-9), 1)) + " sentences/sec)\n")
+  if args.engine in ["log", "c2f"]:
+    sys.stderr.write("pruned " + str(pruned) + " chart entries\n")
+  if args.deadline is not None or args.max_length is not None:
+    sys.stderr.write("degraded " + str(sum(degraded.values())) + " sentences ("
+        + str(degraded["length"]) + " over the length cap, " + str(degraded["deadline"]) + " past the deadline)\n")
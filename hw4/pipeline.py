@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+
+""" Parses, postprocesses and scores a file of sentences in one process.
+
+usage: pipeline.py [strings-file] [gold-file] [--treebank FILE] [--output FILE]
+
+Does what
+
+    main.py strings > parses
+    postprocess.py parses > parses.post
+    evalb.py parses.post gold
+
+does, but each sentence goes through all the stages as a tree object, so
+no tree is written out and read back in between. Reports the time spent
+in every stage; --output also writes the postprocessed trees.
+"""
+
+from collections import OrderedDict
+from main import CFG
+
+import argparse
+import evalb
+import sys
+import time
+
+def main():
+  argparser = argparse.ArgumentParser()
+  argparser.add_argument('strings', nargs='?', default='dev.strings', help='file with one sentence per line')
+  argparser.add_argument('gold', nargs='?', default='dev.trees', help='gold trees for the strings')
+  argparser.add_argument('--treebank', default='train.trees.pre.unk', help='preprocessed training trees')
+  argparser.add_argument('--output', default=None, help='write the postprocessed trees to this file')
+  args = argparser.parse_args()
+
+  stages = OrderedDict((stage, 0.0) for stage in ["train", "read gold", "parse", "postprocess", "score", "write"])
+
+  start = time.time()
+  cfg = CFG()
+  no_markovization = CFG()
+  cfg.train(args.treebank)
+  no_markovization.train(args.treebank, False)
+  cfg.finalize()
+  no_markovization.finalize()
+  stages["train"] += time.time() - start
+
+  start = time.time()
+  gold = evalb.read_gold(args.gold)
+  stages["read gold"] += time.time() - start
+
+  outputFile = open(args.output, "w") if args.output is not None else None
+  total = evalb.Score()
+  parsed = 0
+  with open(args.strings) as stringFile:
+    for line, sentence_gold in zip(stringFile, gold):
+      start = time.time()
+      t = cfg.cky_tree(line)
+      if t is None:
+        t = no_markovization.cky_tree(line)
+      parse_end = time.time()
+      stages["parse"] += parse_end - start
+
+      if t is not None:
+        parsed += 1
+        t.restore_unit()
+        t.unbinarize()
+      postprocess_end = time.time()
+      stages["postprocess"] += postprocess_end - parse_end
+
+      total += evalb.score_brackets(evalb.brackets(t) if t is not None else None, sentence_gold)
+      score_end = time.time()
+      stages["score"] += score_end - postprocess_end
+
+      if outputFile is not None:
+        outputFile.write((str(t) if t is not None else "") + "\n")
+        stages["write"] += time.time() - score_end
+  if outputFile is not None:
+    outputFile.close()
+
+  print("parsed\t%d of %d sentences" % (parsed, len(gold)))
+  print("precision\t%s" % total.precision())
+  print("recall\t%s" % total.recall())
+  print("F1\t%s" % total.f1())
+  for stage, seconds in stages.items():
+    sys.stderr.write("%-12s %8.3fs\n" % (stage, seconds))
+  sys.stderr.write("%-12s %8.3fs\n" % ("total", sum(stages.values())))
+
+if __name__ == "__main__":
+  main()
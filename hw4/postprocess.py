@@ -3,15 +3,18 @@
 import sys, fileinput
 import tree
 
-for line in fileinput.input():
+def postprocess(line):
+    """ Undoes the preprocessing of one parse, returning "" if it is not a tree """
     try:
         t = tree.Tree.from_str(line)
 
         t.restore_unit()
         t.unbinarize()
 
-        print(t)
-    except:
-        print("")
-    
-    
+        return str(t)
+    except Exception:
+        return ""
+
+if __name__ == "__main__":
+    for line in fileinput.input():
+        print(postprocess(line))
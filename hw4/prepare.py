@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+
+""" Preprocesses a treebank for training in one command. Equivalent to
+
+    preprocess.py treebank | unknown.py
+
+but the words are counted in a first pass that only scans the leaves, and
+the trees are then rewritten one line at a time, so no trees are kept in
+memory. With --workers, both passes run over chunks of the file in
+parallel and the rewritten chunks are written out in order.
+
+usage: prepare.py treebank [--workers N] > treebank.pre.unk
+"""
+
+import collections
+import forkpool
+import os
+import shutil
+import sys
+import tempfile
+import tree
+
+def transform(t):
+    """ Binarizes a tree and removes its unary nodes, as preprocess.py does. """
+    # Binarize, inserting 'X*' nodes.
+    t.binarize()
+
+    # Remove unary nodes
+    t.remove_unit()
+
+    # Make sure that all the roots still have the same label.
+    assert t.root.label == 'TOP'
+    return t
+
+def chunk_offsets(filename, chunks):
+    """ Splits a file into at most `chunks` byte ranges that start and end
+    on line boundaries. """
+    size = os.path.getsize(filename)
+    offsets = [0]
+    with open(filename, 'rb') as f:
+        for i in range(1, chunks):
+            f.seek(max(size * i // chunks, offsets[-1]))
+            if f.tell() > 0:
+                f.seek(f.tell() - 1)
+                f.readline()
+            if f.tell() > offsets[-1] and f.tell() < size:
+                offsets.append(f.tell())
+    offsets.append(size)
+    return list(zip(offsets[:-1], offsets[1:]))
+
+def read_lines(filename, start, end):
+    """ Yields the lines of a file that start in the byte range [start, end). """
+    with open(filename, 'rb') as f:
+        f.seek(start)
+        while f.tell() < end:
+            line = f.readline()
+            if not line:
+                break
+            yield line.decode('utf-8')
+
+def count_words(chunk):
+    """ Pass 1: counts the leaves in a chunk of a treebank. """
+    filename, start, end = chunk
+    count = collections.Counter()
+    for line in read_lines(filename, start, end):
+        count.update(tree.Tree.leaves_from_str(line))
+    return count
+
+def rewrite(chunk):
+    """ Pass 2: preprocesses a chunk of a treebank, replacing rare words with
+    <unk>, into a temporary file in the chunk's directory, whose name is
+    returned. The word counts are forkpool.shared(). """
+    count = forkpool.shared()
+    filename, start, end, directory = chunk
+    with tempfile.NamedTemporaryFile('w', suffix='.pre.unk', dir=directory, delete=False) as out:
+        for line in read_lines(filename, start, end):
+            t = transform(tree.Tree.from_str(line))
+            for leaf in t.leaves():
+                if count[leaf.label] < 2:
+                    leaf.label = "<unk>"
+            out.write("{0}\n".format(t))
+        return out.name
+
+def prepare(filename, out, workers=1):
+    """ Writes the preprocessed form of a treebank file to out. """
+    chunks = [(filename, start, end) for (start, end) in chunk_offsets(filename, workers)]
+    count = sum(forkpool.fork_map(count_words, chunks, workers), collections.Counter())
+    # The pieces are removed with their directory, even on an error
+    with tempfile.TemporaryDirectory(suffix='.prepare') as directory:
+        # Forked again, so that the workers see the counts
+        pieces = forkpool.fork_map(rewrite, [chunk + (directory,) for chunk in chunks], workers, count)
+        for piece in pieces:
+            with open(piece) as f:
+                shutil.copyfileobj(f, out)
+
+if __name__ == "__main__":
+    import argparse
+
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument('treebank', help='one tree per line, as in train.trees')
+    argparser.add_argument('--workers', type=int, default=1, help='number of processes')
+    args = argparser.parse_args()
+
+    prepare(args.treebank, sys.stdout, args.workers)
@@ -3,8 +3,7 @@
 import sys, fileinput
 import tree
 
-for line in fileinput.input():
-    t = tree.Tree.from_str(line)
+for t in tree.Tree.from_file(fileinput.input()):
 
     # Binarize, inserting 'X*' nodes.
     t.binarize()
@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+
+""" Summarizes a trace written by main.py --trace.
+
+usage: tracesummary.py <trace-file> [--bucket N]
+
+Prints, for every sentence length bucket, latency percentiles and the number
+of sentences that needed the fallback grammar, got only a partial parse
+because of --deadline or --max-length, or got no parse at all.
+"""
+
+from collections import defaultdict
+from forkpool import percentile
+
+import argparse
+import json
+
+def read_trace(filename):
+  """ Returns the records of a trace file, in sentence order
+  """
+  with open(filename) as traceFile:
+    records = [json.loads(line) for line in traceFile if line.strip()]
+  return sorted(records, key=lambda record: record["sentence"])
+
+def row(name, records):
+  seconds = sorted(record["seconds"] for record in records)
+  fallback = sum(1 for record in records if record["fallback"])
+  degraded = sum(1 for record in records if record.get("degraded"))
+  failed = sum(1 for record in records if not record["parsed"])
+  cells = [record["cells"] for record in records if "cells" in record]
+  return "%-9s %9d %9.2f %9.2f %9.2f %9.2f %9d %9d %9d %9s" % (name, len(records),
+      1000 * percentile(seconds, 0.5), 1000 * percentile(seconds, 0.9),
+      1000 * percentile(seconds, 0.99), 1000 * seconds[-1], fallback, degraded, failed,
+      "%.1f" % (float(sum(cells)) / len(cells)) if cells else "-")
+
+def main():
+  argparser = argparse.ArgumentParser()
+  argparser.add_argument('trace', help='file written by main.py --trace')
+  argparser.add_argument('--bucket', type=int, default=5, help='width of each sentence length bucket')
+  args = argparser.parse_args()
+
+  records = read_trace(args.trace)
+  buckets = defaultdict(list)
+  for record in records:
+    buckets[(record["length"] - 1) // args.bucket].append(record)
+
+  print("%-9s %9s %9s %9s %9s %9s %9s %9s %9s %9s" % ("length", "sentences", "p50 ms",
+      "p90 ms", "p99 ms", "max ms", "fallback", "degraded", "failed", "cells"))
+  for bucket in sorted(buckets):
+    low = bucket * args.bucket + 1
+    print(row("%d-%d" % (low, low + args.bucket - 1), buckets[bucket]))
+  if records:
+    print(row("all", records))
+
+if __name__ == "__main__":
+  main()
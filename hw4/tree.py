@@ -4,6 +4,8 @@ class RootDeletedException(Exception):
     pass
 
 class Node(object):
+    __slots__ = ['label', 'children', 'parent', 'order']
+
     def __init__(self, label, children):
         self.label = label
         self.children = children
@@ -49,6 +51,23 @@ class Node(object):
         for j in range(i,len(self.children)):
             self.children[j].order = j
 
+    def _adopt(self, children):
+        """ Replaces this node's children with a list of parentless nodes,
+        numbering them in one pass. """
+        self.children = children
+        for (i,child) in enumerate(children):
+            child.parent = self
+            child.order = i
+
+    def _release(self):
+        """ Detaches all children at once, returning them. """
+        children = self.children
+        for child in children:
+            child.parent = None
+            child.order = 0
+        self.children = []
+        return children
+
     def detach(self):
         if self.parent is None:
             raise RootDeleteException
@@ -61,19 +80,42 @@ class Node(object):
         if len(parent.children) == 0:
             parent.delete_clean()
 
+    def _binarize_left(self):
+        """ Folds all but the last child into a left-branching chain of X* nodes. """
+        vlabel = self.label+"*"
+        children = self._release()
+        prev = children[0]
+        for child in children[1:-1]:
+            prev = Node(vlabel, [prev, child])
+        self._adopt([prev, children[-1]])
+
+    def _binarize_right(self):
+        """ Folds all but the first child into a right-branching chain of X* nodes. """
+        vlabel = self.label+"*"
+        children = self._release()
+        prev = children[-1]
+        for child in reversed(children[1:-1]):
+            prev = Node(vlabel, [child, prev])
+        self._adopt([children[0], prev])
+
     def bottomup(self):
-        for child in self.children:
-            for node in child.bottomup():
+        stack = [(self, 0)]
+        while stack:
+            (node, i) = stack.pop()
+            if i < len(node.children):
+                stack.append((node, i+1))
+                stack.append((node.children[i], 0))
+            else:
                 yield node
-        yield self
 
     def leaves(self):
-        if len(self.children) == 0:
-            yield self
-        else:
-            for child in self.children:
-                for leaf in child.leaves():
-                    yield leaf
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            if len(node.children) == 0:
+                yield node
+            else:
+                stack.extend(reversed(node.children))
 
 class Tree(object):
     def __init__(self, root):
@@ -87,33 +129,67 @@ class Tree(object):
     leaf_node = re.compile(r'\s*([^\s)]+)')
 
     @staticmethod
-    def _scan_tree(s):
-        result = Tree.interior_node.match(s)
-        if result != None:
-            label = result.group(1)
-            pos = result.end()
-            children = []
-            (child, length) = Tree._scan_tree(s[pos:])
-            while child != None:
-                children.append(child)
-                pos += length
-                (child, length) = Tree._scan_tree(s[pos:])
-            result = Tree.close_brace.match(s[pos:])
+    def _scan_tree(s, pos=0):
+        """ Reads one tree starting at s[pos]. Returns the root and the position
+        just after it, or (None, 0) if there is no well-formed tree there.
+        Works in a single pass with an explicit stack, so it neither copies
+        the string nor recurses. """
+        stack = []
+        while True:
+            result = Tree.interior_node.match(s, pos)
             if result != None:
-                pos += result.end()
-                return Node(label, children), pos
-            else:
-                return (None, 0)
-        else:
-            result = Tree.leaf_node.match(s)
+                # Open a node; its children follow
+                stack.append((result.group(1), []))
+                pos = result.end()
+                continue
+            result = Tree.leaf_node.match(s, pos)
             if result != None:
                 pos = result.end()
-                label = result.group(1)
+                node = Node(result.group(1), [])
                 #label = label.replace("-LRB-", "(")
                 #label = label.replace("-RRB-", ")")
-                return (Node(label,[]), pos)
+            elif stack:
+                # No more children, so the innermost open node must be closed
+                result = Tree.close_brace.match(s, pos)
+                if result == None:
+                    return (None, 0)
+                pos = result.end()
+                label, children = stack.pop()
+                node = Node(label, children)
             else:
                 return (None, 0)
+            if not stack:
+                return (node, pos)
+            stack[-1][1].append(node)
+
+    @staticmethod
+    def leaves_from_str(s):
+        """ Returns the leaf labels of the tree that from_str would read from
+        s, without building any nodes, or None if there is no tree. """
+        s = s.strip()
+        pos = 0
+        depth = 0
+        leaves = []
+        while True:
+            result = Tree.interior_node.match(s, pos)
+            if result != None:
+                depth += 1
+                pos = result.end()
+                continue
+            result = Tree.leaf_node.match(s, pos)
+            if result != None:
+                pos = result.end()
+                leaves.append(result.group(1))
+            elif depth > 0:
+                result = Tree.close_brace.match(s, pos)
+                if result == None:
+                    return None
+                pos = result.end()
+                depth -= 1
+            else:
+                return None
+            if depth == 0:
+                return leaves
 
     @staticmethod
     def from_str(s):
@@ -121,6 +197,13 @@ class Tree(object):
         (tree, n) = Tree._scan_tree(s)
         return Tree(tree)
 
+    @staticmethod
+    def from_file(f):
+        """ Yields the tree on each line of a file handle, reading the file
+        one line at a time. """
+        for line in f:
+            yield Tree.from_str(line)
+
     def bottomup(self):
         """ Traverse the nodes of the tree bottom-up. """
         return self.root.bottomup()
@@ -147,46 +230,34 @@ class Tree(object):
                 child = node.children[0]
                 if len(child.children) > 0:
                     node.label = "%s_%s" % (node.label, child.label)
-                    child.detach()
-                    for grandchild in list(child.children):
-                        node.append_child(grandchild)
+                    node._release()
+                    node._adopt(child._release())
 
     def restore_unit(self):
         """ Restore the unary nodes that were removed by remove_unit(). """
-        def visit(node):
-            children = [visit(child) for child in node.children]
+        built = {}
+        for node in self.bottomup():
+            children = [built.pop(child) for child in node.children]
             labels = node.label.split('_')
-            node = Node(labels[-1], children)
+            new = Node(labels[-1], children)
             for label in reversed(labels[:-1]):
-                node = Node(label, [node])
-            return node
-        self.root = visit(self.root)
+                new = Node(label, [new])
+            built[node] = new
+        self.root = built[self.root]
 
     def binarize_right(self):
         """ Binarize into a right-branching structure. """
         nodes = list(self.bottomup())
         for node in nodes:
             if len(node.children) > 2:
-                # create a right-branching structure
-                children = list(node.children)
-                children.reverse()
-                vlabel = node.label+"*"
-                prev = children[0]
-                for child in children[1:-1]:
-                    prev = Node(vlabel, [child, prev])
-                node.append_child(prev)
+                node._binarize_right()
 
     def binarize_left(self):
         """ Binarize into a left-branching structure. """
         nodes = list(self.bottomup())
         for node in nodes:
             if len(node.children) > 2:
-                vlabel = node.label+"*"
-                children = list(node.children)
-                prev = children[0]
-                for child in children[1:-1]:
-                    prev = Node(vlabel, [prev, child])
-                node.insert_child(0, prev)
+                node._binarize_left()
 
     def binarize(self):
         """ Binarize into a left-branching or right-branching structure
@@ -196,32 +267,22 @@ class Tree(object):
         for node in nodes:
             if len(node.children) > 2:
                 if node.label in ['SQ']:
-                    # create a right-branching structure
-                    children = list(node.children)
-                    children.reverse()
-                    vlabel = node.label+"*"
-                    prev = children[0]
-                    for child in children[1:-1]:
-                        prev = Node(vlabel, [child, prev])
-                    node.append_child(prev)
+                    node._binarize_right()
                 else:
-                    # create a left-branching structure
-                    vlabel = node.label+"*"
-                    children = list(node.children)
-                    prev = children[0]
-                    for child in children[1:-1]:
-                        prev = Node(vlabel, [prev, child])
-                    node.insert_child(0, prev)
+                    node._binarize_left()
 
     def unbinarize(self):
         """ Undo binarization by removing any nodes ending with *. """
-        def visit(node):
-            children = sum([visit(child) for child in node.children], [])
+        built = {}
+        for node in self.bottomup():
+            children = []
+            for child in node.children:
+                children.extend(built.pop(child))
             if node.label.endswith('*'):
-                return children
+                built[node] = children
             else:
-                return [Node(node.label, children)]
-        roots = visit(self.root)
+                built[node] = [Node(node.label, children)]
+        roots = built[self.root]
         assert len(roots) == 1
         self.root = roots[0]
 
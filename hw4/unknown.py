@@ -7,8 +7,7 @@ import tree
 count = collections.defaultdict(int)
 
 trees = []
-for line in fileinput.input():
-    t = tree.Tree.from_str(line)
+for t in tree.Tree.from_file(fileinput.input()):
     for leaf in t.leaves():
         count[leaf.label] += 1
     trees.append(t)
@@ -0,0 +1,136 @@
+import numpy as np
+
+class VectorizedCKY(object):
+  """ CKY over a trained CFG using integer nonterminals and numpy arrays.
+
+  The chart is a triangular array with one row of scores per span (i, j),
+  and the max over split points and rules for all spans of one length is
+  done as a single batch of array operations. Scores are kept as probabilities and multiplied
+  in the same order as CFG.cky, so both engines return the same tree.
+  """
+  def __init__(self, cfg):
+    self.rules = list(cfg.rules)
+    self.words_seen = cfg.words_seen
+    table = cfg.probability_table()
+
+    # Give every nonterminal an integer ID
+    self.symbols = []
+    self.symbol_ids = {}
+    for rule in self.rules:
+      self._symbol_id(rule.base)
+      if len(rule.goes_to) == 2:
+        for child in rule.goes_to:
+          self._symbol_id(child)
+
+    # Lexicon: word -> [(rule index, parent ID, probability)]
+    self.lexicon = {}
+    for index, rule in enumerate(self.rules):
+      for token in set(rule.goes_to):
+        entry = (index, self.symbol_ids[rule.base], table[rule])
+        self.lexicon.setdefault(token, []).append(entry)
+
+    # Binary rules as parallel arrays, grouped by parent. Within a group
+    # the rules keep their order in cfg.rules, which decides ties.
+    binary = [index for index, rule in enumerate(self.rules) if len(rule.goes_to) == 2]
+    binary.sort(key=lambda index: self.symbol_ids[self.rules[index].base])
+    self.rule_index = np.array(binary, dtype=np.int64)
+    self.rule_parent = np.array([self.symbol_ids[self.rules[r].base] for r in binary], dtype=np.int64)
+    self.rule_left = np.array([self.symbol_ids[self.rules[r].goes_to[0]] for r in binary], dtype=np.int64)
+    self.rule_right = np.array([self.symbol_ids[self.rules[r].goes_to[1]] for r in binary], dtype=np.int64)
+    self.rule_prob = np.array([table[self.rules[r]] for r in binary], dtype=np.float64)
+
+    # Start of each parent's block of rules
+    starts = np.flatnonzero(np.diff(self.rule_parent)) + 1
+    self.group_starts = np.concatenate(([0], starts)).astype(np.int64)
+    self.group_parent = self.rule_parent[self.group_starts]
+    self.group_of_rule = np.repeat(np.arange(len(self.group_starts)),
+        np.diff(np.append(self.group_starts, len(binary))))
+
+    self.top = self.symbol_ids.get('TOP')
+
+  def _symbol_id(self, symbol):
+    if symbol not in self.symbol_ids:
+      self.symbol_ids[symbol] = len(self.symbols)
+      self.symbols.append(symbol)
+    return self.symbol_ids[symbol]
+
+  @staticmethod
+  def span_index(n, i, j):
+    """ Row of span (i, j) in the triangular chart of a sentence of length n
+    """
+    return i * n - i * (i - 1) // 2 + (j - i - 1)
+
+  def cky(self, string):
+    """ Finds the highest probability parse of a given string
+    """
+    words = string.strip().split(" ")
+    n = len(words)
+    num_symbols = len(self.symbols)
+    num_spans = n * (n + 1) // 2
+    num_rules = len(self.rule_index)
+
+    score = np.zeros((num_spans, num_symbols))
+    back_rule = np.full((num_spans, num_symbols), -1, dtype=np.int64)
+    back_split = np.full((num_spans, num_symbols), -1, dtype=np.int64)
+
+    # Do top row
+    for i in range(n):
+      word = words[i]
+      if word not in self.words_seen:
+        word = "<unk>"
+      row = self.span_index(n, i, i+1)
+      for index, parent, p in self.lexicon.get(word, ()):
+        if p > score[row, parent]:
+          score[row, parent] = p
+          back_rule[row, parent] = index
+
+    # Fill in other rows, all spans of the same length at once
+    if num_rules > 0:
+      rules = np.arange(num_rules)
+      for l in range(2, n + 1):
+        starts = np.arange(0, n-l+1)
+        splits = starts[:, None] + np.arange(1, l)[None, :]
+        rows = self.span_index(n, starts, starts + l)
+        left_rows = self.span_index(n, starts[:, None], splits)
+        right_rows = self.span_index(n, splits, (starts + l)[:, None])
+
+        # scores[s, k, r] for every span s, split point k and binary rule r
+        scores = self.rule_prob * score[left_rows][:, :, self.rule_left]
+        scores *= score[right_rows][:, :, self.rule_right]
+
+        # Best split per rule, then best rule per parent
+        rule_split = scores.argmax(axis=1)
+        rule_best = scores[np.arange(len(starts))[:, None], rule_split, rules]
+        group_best = np.maximum.reduceat(rule_best, self.group_starts, axis=1)
+
+        # Among rules reaching the parent's best score, the earliest split
+        # wins, then the earliest rule, as in CFG.cky
+        key = rule_split * num_rules + rules
+        key[rule_best != group_best[:, self.group_of_rule]] = l * num_rules
+        winner = np.minimum.reduceat(key, self.group_starts, axis=1) % num_rules
+
+        span, group = np.nonzero(group_best > 0.0)
+        parents = self.group_parent[group]
+        winner = winner[span, group]
+        score[rows[span], parents] = group_best[span, group]
+        back_rule[rows[span], parents] = self.rule_index[winner]
+        back_split[rows[span], parents] = rule_split[span, winner] + starts[span] + 1
+
+    if self.top is None or back_rule[self.span_index(n, 0, n), self.top] < 0:
+      return None
+
+    def make_tree(i, j, symbol):
+      row = self.span_index(n, i, j)
+      rule = self.rules[back_rule[row, symbol]]
+      k = back_split[row, symbol]
+      ###################################################
+      # Remove Vertical Markovization and latent subcategories
+      label = rule.base.split("[")[0]
+      if k < 0:
+        return "(" + label + " " + rule.goes_to[0] + ")"
+      left_tree = make_tree(i, k, self.symbol_ids[rule.goes_to[0]])
+      right_tree = make_tree(k, j, self.symbol_ids[rule.goes_to[1]])
+      return "(" + label + " " + left_tree + " " + right_tree + ")"
+      ###################################################
+
+    return make_tree(0, n, self.top)
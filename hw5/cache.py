@@ -0,0 +1,30 @@
+from collections import OrderedDict
+
+class LRUCache(object):
+  """ A dict that holds at most maxsize entries, forgetting the least
+  recently used one when full, and counts its hits and misses
+  """
+  def __init__(self, maxsize=100000):
+    self.maxsize = maxsize
+    self._entries = OrderedDict()
+    self.hits = 0
+    self.misses = 0
+
+  def __len__(self):
+    return len(self._entries)
+
+  def get(self, key, default=None):
+    """ Returns the value for key, or default if it is not cached
+    """
+    if key in self._entries:
+      self._entries.move_to_end(key)
+      self.hits += 1
+      return self._entries[key]
+    self.misses += 1
+    return default
+
+  def put(self, key, value):
+    self._entries[key] = value
+    self._entries.move_to_end(key)
+    if len(self._entries) > self.maxsize:
+      self._entries.popitem(last=False)
@@ -0,0 +1,333 @@
+#!/usr/bin/env python
+
+""" Beam-limited chart decoding with cube pruning (Chiang 2007).
+
+usage: cube.py rules-file input-file [reference-file] [--beam N...]
+               [--lm FILE [--lm-order N] [--lm-weight W]]
+
+Decodes the input with the exhaustive decoder and with each beam size,
+reporting the time taken, the slowest sentence, how many translations
+differ from the exhaustive ones and, with a reference, BLEU. With --lm,
+the beam decoders also score the English with an n-gram language model.
+"""
+
+import heapq
+import math
+
+class Hypothesis:
+  """ A translation of a span: a rule applied to hypotheses for the spans
+  of its children, if it has any
+  """
+  __slots__ = ['score', 'base', 'rule', 'k', 'left', 'right', 'boundary']
+
+  def __init__(self, score, rule, k=None, left=None, right=None, boundary=None):
+    self.score = score
+    self.base = rule.base
+    self.rule = rule
+    self.k = k
+    self.left = left
+    self.right = right
+    # With a language model, (first n-1 words, last n-1 words, number of
+    # words) of the English
+    self.boundary = boundary
+
+  def state(self):
+    """ Hypotheses with the same state are interchangeable in any larger
+    translation, so only the best of them is kept
+    """
+    if self.boundary is None:
+      return self.base
+    return (self.base, self.boundary[0], self.boundary[1])
+
+# Boundary of a hypothesis with no English, such as a word translated by a
+# lexical rule
+EMPTY = ((), (), 0)
+
+class CubePruningDecoder:
+  """ Decodes with the rules of a trained Translator, keeping at most beam
+  hypotheses per chart cell.
+
+  The hypotheses of a cell are built best first: for every split and every
+  pair of child nonterminals, the candidates form a cube indexed by the
+  rules for that pair and the hypotheses of the two children, each sorted
+  best first. Only the best corner of each cube is queued at first, and
+  the neighbours of a candidate are queued when it is popped, until the
+  cell has beam hypotheses. Without a language model every score is a
+  product of the scores along each axis, so the beam holds exactly the
+  best beam hypotheses of the cell.
+
+  With beam None every hypothesis is kept, and ties are broken by the
+  earliest split and then the earliest rule, so decode gives the same
+  translation as Translator._test.
+
+  Given a language model such as lm.WordNGramModel, the score of a
+  hypothesis is also multiplied by the LM probability, to the power
+  lm_weight, of the n-grams of its English that lie wholly inside it. The
+  first n-1 words lack context until the hypothesis is used in a larger
+  one, or the sentence is finished, and hypotheses that share their
+  nonterminal and first and last n-1 words are recombined. Scores are no
+  longer monotonic along the cubes, so the beam is then approximate.
+
+  A cell depends only on the words of its span, so with span_cache, an
+  LRUCache, the cells of spans of two or more words are kept by their
+  words and reused for the same words in later sentences.
+  """
+  def __init__(self, translator, beam=10, lm=None, lm_weight=1.0, span_cache=None):
+    self.translator = translator
+    self.beam = beam
+    self.lm = lm
+    self.lm_weight = lm_weight
+    self.span_cache = span_cache
+    self._pair_rules = {}
+
+  def rules_for_pair(self, Y, Z):
+    """ Returns (rule, rule number) for the rules whose source side is
+    Y Z, most probable first
+    """
+    rules = self._pair_rules.get((Y, Z))
+    if rules is None:
+      table = self.translator.rules
+      rules = [(table.rule(r), r) for r in table.with_pair(Y, Z)]
+      rules = [(rule, r) for (rule, r) in rules if rule.prob > 0]
+      rules.sort(key=lambda entry: (-entry[0].prob, entry[1]))
+      self._pair_rules[Y, Z] = rules
+    return rules
+
+  def _full(self, size):
+    return self.beam is not None and size >= self.beam
+
+  def _add(self, cell, hypothesis, states):
+    """ Adds a hypothesis to a cell unless one with the same state is
+    already there. Returns whether it was added.
+    """
+    state = hypothesis.state()
+    if state in states:
+      return False
+    states.add(state)
+    cell.setdefault(hypothesis.base, []).append(hypothesis)
+    return True
+
+  def _join(self, segments, anchored=False):
+    """ Puts the English of segments, a list of boundaries, one after the
+    other. Returns the LM log-probability of the words that get their
+    full context from this, and the boundary of the result. If anchored,
+    the segments start the sentence.
+    """
+    order = self.lm.n - 1
+    logprob = 0.0
+    first = []
+    last = ["<s>"] if anchored else []
+    length = 0
+    for (s_first, s_last, s_length) in segments:
+      for t, w in enumerate(s_first):
+        if anchored or length + t >= order:
+          context = (last + list(s_first[:t]))[-order:] if order > 0 else []
+          logprob += self.lm.logprob(tuple(context), w)
+      if length < order:
+        first = (first + list(s_first))[:order]
+      last = (last + list(s_last))[-order:] if order > 0 else []
+      length += s_length
+    return logprob, (tuple(first), tuple(last), length)
+
+  def _segments(self, rule, left, right):
+    """ Returns the boundaries of the English of a binary rule applied to
+    two hypotheses, in order
+    """
+    segments = []
+    for token in rule.english:
+      if "[0]" in token:
+        segments.append(left.boundary)
+      elif "[1]" in token:
+        segments.append(right.boundary)
+      else:
+        segments.append(((token,), (token,), 1))
+    return segments
+
+  def _lm_factor(self, logprob):
+    return math.exp(self.lm_weight * logprob)
+
+  def _word_cell(self, word):
+    table = self.translator.rules
+    candidates = []
+    for r in table.with_token(word):
+      rule = table.rule(r)
+      if rule.prob > 0:
+        candidates.append((-rule.prob, r, rule))
+    candidates.sort(key=lambda candidate: candidate[:2])
+
+    cell = {}
+    states = set()
+    size = 0
+    boundary = EMPTY if self.lm is not None else None
+    for neg_score, r, rule in candidates:
+      if self._full(size):
+        break
+      if self._add(cell, Hypothesis(rule.prob, rule, boundary=boundary), states):
+        size += 1
+    return cell
+
+  def _combine(self, cells, i, j):
+    """ Fills cell (i, j) from the cells of its sub-spans by cube pruning
+    """
+    groups = []
+    heap = []
+    queued = set()
+
+    def push(g, a, b, c):
+      k, rules, lefts, rights = groups[g]
+      if a >= len(rules) or b >= len(lefts) or c >= len(rights) or (g, a, b, c) in queued:
+        return
+      queued.add((g, a, b, c))
+      rule, r = rules[a]
+      score = rule.prob * lefts[b].score * rights[c].score
+      boundary = None
+      if self.lm is not None:
+        logprob, boundary = self._join(self._segments(rule, lefts[b], rights[c]))
+        score *= self._lm_factor(logprob)
+      heapq.heappush(heap, (-score, k, r, a, b, c, g, boundary))
+
+    for k in range(i+1, j):
+      for Y, lefts in cells[i, k].items():
+        for Z, rights in cells[k, j].items():
+          rules = self.rules_for_pair(Y, Z)
+          if rules:
+            groups.append((k, rules, lefts, rights))
+            push(len(groups) - 1, 0, 0, 0)
+
+    cell = {}
+    states = set()
+    size = 0
+    while heap and not self._full(size):
+      neg_score, k, r, a, b, c, g, boundary = heapq.heappop(heap)
+      k, rules, lefts, rights = groups[g]
+      if self._add(cell, Hypothesis(-neg_score, rules[a][0], k, lefts[b], rights[c], boundary), states):
+        size += 1
+      push(g, a + 1, b, c)
+      push(g, a, b + 1, c)
+      push(g, a, b, c + 1)
+
+    if self.lm is not None:
+      # The LM can make a later pop score better than an earlier one
+      for hypotheses in cell.values():
+        hypotheses.sort(key=lambda hypothesis: -hypothesis.score)
+    return cell
+
+  def decode(self, line):
+    """ Returns the translation of a line, or None if there is none
+    """
+    words = line.split(" ")
+    n = len(words)
+    cells = {}
+
+    # Do top row
+    for i in range(1, n+1):
+      word = words[i-1]
+      if word not in self.translator.words_seen:
+        word = "<unk>"
+      cells[i-1, i] = self._word_cell(word)
+
+    # Fill in other rows
+    for l in range(2, n + 1):
+      for i in range(0, n-l+1):
+        if self.span_cache is None:
+          cells[i, i+l] = self._combine(cells, i, i+l)
+          continue
+        span = tuple(words[i:i+l])
+        cell = self.span_cache.get(span)
+        if cell is None:
+          cell = self._combine(cells, i, i+l)
+          self.span_cache.put(span, cell)
+        cells[i, i+l] = cell
+
+    if 'PHRASE' not in cells[0, n]:
+      return None
+    return self.translation(self._best(cells[0, n]['PHRASE']))
+
+  def _best(self, hypotheses):
+    """ Returns the best of the hypotheses for a whole sentence, once the
+    LM has scored the words at its edges
+    """
+    if self.lm is None:
+      return hypotheses[0]
+    best = None
+    best_score = None
+    for hypothesis in hypotheses:
+      logprob, _ = self._join([hypothesis.boundary, (("</s>",), ("</s>",), 1)], anchored=True)
+      score = hypothesis.score * self._lm_factor(logprob)
+      if best is None or score > best_score:
+        best = hypothesis
+        best_score = score
+    return best
+
+  def translation(self, hypothesis):
+    """ Builds the translation of a hypothesis as Translator._test does
+    """
+    if hypothesis.k is None:
+      return ""
+    s = ""
+    for token in hypothesis.rule.english:
+      if "[0]" in token:
+        s += self.translation(hypothesis.left)
+      elif "[1]" in token:
+        s += self.translation(hypothesis.right)
+      else:
+        s += token
+    return s
+
+def main():
+  import argparse
+  import bleu
+  import time
+  from main import Translator
+
+  argparser = argparse.ArgumentParser()
+  argparser.add_argument('rules', help='rule file')
+  argparser.add_argument('input', help='sentences to translate')
+  argparser.add_argument('reference', nargs='?', default=None, help='reference translations, for BLEU')
+  argparser.add_argument('--beam', type=int, nargs='+', default=[1, 5, 10, 50], help='beam sizes to try')
+  argparser.add_argument('--lm', default=None, help='English text to train a language model on')
+  argparser.add_argument('--lm-order', type=int, default=3, help='n of the language model')
+  argparser.add_argument('--lm-weight', type=float, default=1.0, help='exponent of the language model probability')
+  args = argparser.parse_args()
+
+  translator = Translator()
+  translator.train(args.rules)
+  lm = None
+  if args.lm is not None:
+    from lm import WordNGramModel
+    lm = WordNGramModel(args.lm_order)
+    lm.train(args.lm)
+  with open(args.input) as inputFile:
+    lines = [line.strip() for line in inputFile]
+  references = None
+  if args.reference is not None:
+    with open(args.reference) as referenceFile:
+      references = [line.split() for line in referenceFile]
+
+  exhaustive = None
+  print("%-10s %9s %12s %9s %9s" % ("beam", "seconds", "slowest (s)", "changed", "BLEU"))
+  for beam in [None] + args.beam:
+    decoder = CubePruningDecoder(translator, beam, lm if beam is not None else None, args.lm_weight)
+    translations = []
+    slowest = 0.0
+    start = time.time()
+    for line in lines:
+      sentence_start = time.time()
+      translations.append(decoder.decode(line))
+      slowest = max(slowest, time.time() - sentence_start)
+    elapsed = time.time() - start
+    if exhaustive is None:
+      exhaustive = translations
+    changed = sum(1 for a, b in zip(translations, exhaustive) if a != b)
+
+    score = "-"
+    if references is not None:
+      stats = bleu.zero()
+      for translation, reference in zip(translations, references):
+        stats += bleu.count((translation or "").split(), reference)
+      # bleu.score divides by the number of words guessed
+      score = "%.4f" % bleu.score(stats) if stats['guess', 1] > 0 else "0"
+    print("%-10s %9.3f %12.3f %9d %9s" % ("none" if beam is None else beam, elapsed, slowest, changed, score))
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+
+""" Filters a rule file down to the rules that can fire on a test set.
+
+usage: filterrules.py rules-file input-file... [--output FILE] [--contiguous]
+
+Streams the rule file once and writes the lines of the rules that can be
+used to translate the input files. Translator.train adds the glue and
+identity rules itself, so the output can be decoded in place of the full
+file.
+
+By default a rule is kept if one of its source words is in the input (or
+is <unk>), since that is when Translator._test uses it for a word, or if
+its source side is two nonterminals. Translations are then unchanged.
+--contiguous also requires every run of source words between
+nonterminals to appear contiguously in one input sentence, which is the
+usual filter for phrase-based decoders but can drop rules that
+Translator._test would use.
+"""
+
+from main import RuleTable
+
+import argparse
+import sys
+import time
+
+def read_input(filenames):
+  """ Returns the sentences of the input files as lists of words
+  """
+  sentences = []
+  for filename in filenames:
+    with open(filename) as inputFile:
+      sentences.extend(line.strip().split(" ") for line in inputFile)
+  return sentences
+
+class RuleFilter:
+  """ Decides which rule lines can fire on a set of sentences
+  """
+  MAX_NGRAM = 5
+
+  def __init__(self, sentences, contiguous=False):
+    self.contiguous = contiguous
+    self.words = set(word for sentence in sentences for word in sentence)
+    self.words.add("<unk>")
+
+    # Every n-gram of the input up to MAX_NGRAM words; longer runs are
+    # searched for in the text
+    self.ngrams = set()
+    for sentence in sentences:
+      for i in range(len(sentence)):
+        for j in range(i + 1, min(i + self.MAX_NGRAM, len(sentence)) + 1):
+          self.ngrams.add(tuple(sentence[i:j]))
+    self.text = "\n".join(" " + " ".join(sentence) + " " for sentence in sentences)
+
+  def keep(self, line):
+    chinese = line.split("\t", 2)[1].split()
+    terminals = [token for token in chinese if "[" not in token]
+    if not terminals:
+      return len(chinese) == 2
+    if not self.contiguous:
+      return any(token.split("[")[0] in self.words for token in chinese)
+
+    run = []
+    for token in chinese + ["[]"]:
+      if "[" not in token:
+        run.append(token)
+      elif run:
+        if not self._occurs(run):
+          return False
+        run = []
+    return True
+
+  def _occurs(self, run):
+    if len(run) <= self.MAX_NGRAM:
+      return tuple(run) in self.ngrams
+    return (" " + " ".join(run) + " ") in self.text
+
+def filter_rules(rule_filename, sentences, output, contiguous=False):
+  """ Writes the lines of rule_filename that can fire on sentences to the
+  file handle output. Returns the number of rules read and kept.
+  """
+  rule_filter = RuleFilter(sentences, contiguous)
+  read = 0
+  kept = 0
+  with open(rule_filename, "rb") as ruleFile:
+    for line in ruleFile:
+      if not line.strip():
+        continue
+      read += 1
+      if rule_filter.keep(line.decode("utf-8")):
+        kept += 1
+        output.write(line)
+  return read, kept
+
+def main():
+  argparser = argparse.ArgumentParser()
+  argparser.add_argument('rules', help='full rule file')
+  argparser.add_argument('inputs', nargs='+', help='files of sentences to be translated')
+  argparser.add_argument('--output', default=None, help='filtered rule file (default: rules file + .filtered)')
+  argparser.add_argument('--contiguous', action='store_true', help='require runs of source words to occur contiguously in the input')
+  args = argparser.parse_args()
+  output = args.output if args.output is not None else args.rules + ".filtered"
+
+  start = time.time()
+  with open(output, "wb") as outputFile:
+    read, kept = filter_rules(args.rules, read_input(args.inputs), outputFile, args.contiguous)
+  filter_time = time.time() - start
+
+  # What loading each file for decoding costs
+  start = time.time()
+  RuleTable(args.rules)
+  full_time = time.time() - start
+  start = time.time()
+  RuleTable(output)
+  filtered_time = time.time() - start
+
+  sys.stderr.write("kept " + str(kept) + " of " + str(read) + " rules ("
+      + str(round(100.0 * kept / max(read, 1), 2)) + "%) in " + output + "\n")
+  sys.stderr.write("filtered in " + str(round(filter_time, 2)) + "s; loading takes "
+      + str(round(filtered_time, 2)) + "s instead of " + str(round(full_time, 2)) + "s\n")
+
+if __name__ == "__main__":
+  main()
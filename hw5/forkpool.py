@@ -0,0 +1,63 @@
+""" Runs a function over items in a pool of forked worker processes.
+
+The object the function needs, such as a trained grammar, is passed as
+`shared` and read back with shared() inside the function. It is set
+before the workers are forked, so they get it without any pickling and
+share its memory pages with the parent. With one worker, everything runs
+in this process instead.
+"""
+
+import multiprocessing
+
+_shared = None
+
+def shared():
+  """ Returns the shared object of the fork_imap or fork_map call that is
+  running the current function
+  """
+  return _shared
+
+def shards(n, workers):
+  """ Splits range(n) into at most workers (start, end) ranges of nearly
+  equal size
+  """
+  size = max(1, (n + workers - 1) // workers)
+  return [(start, min(start + size, n)) for start in range(0, n, size)]
+
+def fork_imap(function, items, workers=1, chunksize=1, shared=None):
+  """ Yields function(item) for every item, in input order, each as soon
+  as it and all earlier ones are done. The pool is shut down, and its
+  workers waited for, when the results run out or are abandoned.
+  """
+  global _shared
+  previous = _shared
+  _shared = shared
+  try:
+    if workers <= 1:
+      for item in items:
+        yield function(item)
+      return
+
+    pool = multiprocessing.get_context("fork").Pool(workers)
+    try:
+      for result in pool.imap(function, items, chunksize):
+        yield result
+    finally:
+      pool.terminate()
+      pool.join()
+  finally:
+    _shared = previous
+
+def fork_map(function, items, workers=1, shared=None):
+  """ Returns [function(item) for item in items], computed by fork_imap
+  """
+  return list(fork_imap(function, items, workers, 1, shared))
+
+def percentile(values, fraction):
+  """ Returns the value below which the given fraction of sorted values
+  fall, by the nearest rank, for reporting the latency of the results
+  """
+  if not values:
+    return 0.0
+  rank = max(0, min(len(values) - 1, int(fraction * len(values) + 0.5) - 1))
+  return values[rank]
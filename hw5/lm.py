@@ -0,0 +1,63 @@
+from cache import LRUCache
+from collections import Counter
+
+import math
+
+class WordNGramModel(object):
+  """ A word-level version of hw2's NGramModel for scoring translations.
+
+  Probabilities are interpolated with the same Witten-Bell weights:
+  lambda(u) = c(u.) / (c(u.) + number of distinct words seen after u).
+  Unigrams are add-one smoothed so that unknown words get some mass.
+  Sentences are scored between <s> and </s>. Contexts are tuples of at
+  most n-1 words, and queries are memoized in an LRUCache.
+  """
+  def __init__(self, n, cache_size=100000):
+    self.n = n
+    self.counts = Counter()     # n-gram tuple -> count, for every order up to n
+    self.followers = Counter()  # context tuple -> c(u.)
+    self.types = Counter()      # context tuple -> distinct words after it
+    self.total = 0
+    self.vocabulary = 0
+    self.cache = LRUCache(cache_size)
+
+  def train(self, filename):
+    with open(filename) as trainFile:
+      for line in trainFile:
+        words = ["<s>"] + line.split() + ["</s>"]
+        for i in range(1, len(words)):
+          self.total += 1
+          for size in range(1, self.n + 1):
+            if i - size + 1 < 0:
+              break
+            gram = tuple(words[i-size+1:i+1])
+            if self.counts[gram] == 0:
+              if size > 1:
+                self.types[gram[:-1]] += 1
+              else:
+                self.vocabulary += 1
+            self.counts[gram] += 1
+            if size > 1:
+              self.followers[gram[:-1]] += 1
+
+  def prob(self, context, w):
+    """ Returns the probability of w following the words in context
+    """
+    if not context:
+      return (self.counts[(w,)] + 1.0) / (self.total + self.vocabulary + 1.0)
+    count = self.followers[context]
+    lower = self.prob(context[1:], w)
+    if count == 0:
+      return lower
+    lambda_u = float(count) / (count + self.types[context])
+    return lambda_u * self.counts[context + (w,)] / count + (1 - lambda_u) * lower
+
+  def logprob(self, context, w):
+    """ Returns the natural log of prob(context, w), memoized
+    """
+    key = (context[-(self.n - 1):] if self.n > 1 else (), w)
+    value = self.cache.get(key)
+    if value is None:
+      value = math.log(self.prob(key[0], w))
+      self.cache.put(key, value)
+    return value
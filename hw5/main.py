@@ -1,5 +1,13 @@
+from cache import LRUCache
 from collections import defaultdict
 
+import array
+import forkpool
+import mmap
+import os
+import sys
+import time
+
 class Rule:
   def __init__(self, line):
     values = line.split("\t")
@@ -16,47 +24,216 @@ class Rule:
 
     self.prob = float(values[3])
 
+def source_tokens(chinese):
+  """ Returns the source symbols of the chinese side of a rule line, as
+  Rule.chinese holds them
+  """
+  return [token.split("[")[0] for token in chinese.split()]
+
+class RuleTable:
+  """ The rules of a grammar, numbered in file order, indexed for the
+  decoder by every source symbol they contain and, for rules with two
+  source symbols, by that pair.
+
+  The rule file is memory-mapped and scanned once, reading only the source
+  side of each line; a line is parsed into a Rule the first time the
+  decoder asks for it. Rules added with add() are numbered after the file.
+  """
+  def __init__(self, filename=None):
+    self._mmap = None
+    self.offsets = array.array("Q")
+    self.words_seen = set()
+    self._by_token = defaultdict(lambda: array.array("I"))
+    self._by_pair = defaultdict(lambda: array.array("I"))
+    self._parsed = {}
+    self._added = []
+    if filename is not None:
+      self._load(filename)
+
+  def _load(self, filename):
+    if os.path.getsize(filename) == 0:
+      return
+    with open(filename, "rb") as ruleFile:
+      self._mmap = mmap.mmap(ruleFile.fileno(), 0, access=mmap.ACCESS_READ)
+
+    offset = 0
+    for line in iter(self._mmap.readline, b""):
+      if line.strip():
+        chinese = source_tokens(line.split(b"\t", 2)[1].decode("utf-8"))
+        self._index(len(self.offsets), chinese)
+        self.offsets.append(offset)
+      offset += len(line)
+
+  def _index(self, r, chinese):
+    for token in set(chinese):
+      self._by_token[token].append(r)
+    if len(chinese) == 1:
+      self.words_seen.add(chinese[0])
+    elif len(chinese) == 2:
+      self._by_pair[chinese[0], chinese[1]].append(r)
+
+  def add(self, rule):
+    self._index(len(self), rule.chinese)
+    self._added.append(rule)
+
+  def __len__(self):
+    return len(self.offsets) + len(self._added)
+
+  def rule(self, r):
+    """ Returns the r-th Rule
+    """
+    if r >= len(self.offsets):
+      return self._added[r - len(self.offsets)]
+    rule = self._parsed.get(r)
+    if rule is None:
+      start = self.offsets[r]
+      end = self._mmap.find(b"\n", start)
+      if end == -1:
+        end = len(self._mmap)
+      rule = self._parsed[r] = Rule(self._mmap[start:end].decode("utf-8"))
+    return rule
+
+  def with_token(self, token):
+    """ Returns the numbers of the rules with token on their source side,
+    in order
+    """
+    return self._by_token.get(token, ())
+
+  def with_pair(self, Y, Z):
+    """ Returns the numbers of the rules whose source side is Y Z, in order
+    """
+    return self._by_pair.get((Y, Z), ())
+
+# Marks a line missing from the memo, since None is a valid translation
+_NOT_CACHED = object()
+
 class Translator:
   def __init__(self):
-    self.rules = []
+    self.rules = RuleTable()
     self.words_seen = set()
+    self.lm = None
+    self.lm_weight = 1.0
+    self.memo = None
+    self.span_memo = None
+    self._decoder = None
 
   def train(self, filename):
     print("Beginning training...")
 
-    with open(filename) as ruleFile:
-      lines = ruleFile.readlines()
-
-    for line in lines:
-      rule = Rule(line)
-      self.rules.append(rule)
-      if len(rule.chinese) == 1:
-        self.words_seen.add(rule.chinese[0])
-    self.rules = [Rule(line) for line in lines]
+    self.rules = RuleTable(filename)
+    self.words_seen = set(self.rules.words_seen)
+    self._decoder = None
+    self._forget()
 
     # Add Glue Rule
     glue_rule = Rule("PHRASE\tPHRASE[0] PHRASE[1]\tPHRASE[0] PHRASE[1]\t1")
-    self.rules.append(glue_rule)
+    self.rules.add(glue_rule)
 
     # Add Identity Rules
     for word in self.words_seen:
       rule = Rule("PHRASE\t" + word + "\t" + word + "\t1e-10")
-      self.rules.append(rule)
+      self.rules.add(rule)
 
     print("Completed training")
 
-  def test_file(self, filename):
+  def use_language_model(self, lm, weight=1.0):
+    """ Makes the beam-limited decoder also score translations with lm,
+    such as an lm.WordNGramModel, raised to the power weight
+    """
+    self.lm = lm
+    self.lm_weight = weight
+    self._decoder = None
+    self._forget()
+
+  def use_memo(self, size=10000, span_size=0):
+    """ Makes translate remember the translations of the last size
+    distinct lines. With span_size, the chart cells of the last span_size
+    distinct runs of two or more words are also remembered, by _test and
+    by the beam-limited decoder, since a cell depends only on the words
+    of its span.
+    """
+    self.memo = LRUCache(size) if size > 0 else None
+    self.span_memo = LRUCache(span_size) if span_size > 0 else None
+    self._decoder = None
+
+  def _forget(self):
+    if self.memo is not None:
+      self.memo = LRUCache(self.memo.maxsize)
+    if self.span_memo is not None:
+      self.span_memo = LRUCache(self.span_memo.maxsize)
+
+  def memo_key(self, line, beam=None):
+    """ Returns the key of a line in the memo. Lines differ only in
+    surrounding whitespace, which translation ignores.
+    """
+    return (line.strip(), beam)
+
+  def memo_stats(self):
+    """ Returns (hits, lookups) of the line memo and of the span memos
+    """
+    span_caches = [self.span_memo]
+    if self._decoder is not None:
+      span_caches.append(self._decoder.span_cache)
+    stats = []
+    for caches in [[self.memo], span_caches]:
+      caches = [cache for cache in caches if cache is not None]
+      hits = sum(cache.hits for cache in caches)
+      stats.append((hits, hits + sum(cache.misses for cache in caches)))
+    return stats
+
+  def test_file(self, filename, beam=None):
+    """ Translates every line of a file, with the beam-limited decoder in
+    cube.py if a beam size is given
+    """
     with open(filename) as testFile:
       #lines = testFile.readlines()[2:3]
       lines = testFile.readlines()
 
     for line in lines:
-      self._test(line.strip())
+      if beam is None:
+        self._test(line.strip())
+      else:
+        self._test_beam(line.strip(), beam)
 
-  def _test(self, line):
-    """ Runs Viterbi Algorithm on this line
+  def _test_beam(self, line, beam):
+    """ Translates this line keeping at most beam hypotheses per chart cell
     """
     print("testing: " + line)
+    translation = self.translate(line, beam)
+    print(translation)
+    return translation
+
+  def translate(self, line, beam=None):
+    """ Returns the translation of a line, or None if there is none,
+    without printing anything. Uses the memo, if there is one (see
+    use_memo).
+    """
+    line = line.strip()
+    if self.memo is None:
+      return self._translate(line, beam)
+    key = self.memo_key(line, beam)
+    translation = self.memo.get(key, _NOT_CACHED)
+    if translation is _NOT_CACHED:
+      translation = self._translate(line, beam)
+      self.memo.put(key, translation)
+    return translation
+
+  def _translate(self, line, beam):
+    if beam is None:
+      return self._test(line, False)
+
+    from cube import CubePruningDecoder
+    if self._decoder is None or self._decoder.beam != beam:
+      # Cells depend on the beam, so the decoder keeps its own
+      span_cache = LRUCache(self.span_memo.maxsize) if self.span_memo is not None else None
+      self._decoder = CubePruningDecoder(self, beam, self.lm, self.lm_weight, span_cache)
+    return self._decoder.decode(line)
+
+  def _test(self, line, verbose=True):
+    """ Runs Viterbi Algorithm on this line
+    """
+    if verbose:
+      print("testing: " + line)
 
     words = line.split(" ")
     n = len(words)
@@ -69,33 +246,50 @@ class Translator:
       word = words[i-1]
       if word not in self.words_seen:
         word = "<unk>"
-      for rule in self.rules:
-        if word in rule.chinese:
-          p = rule.prob
-          if p > best[i-1][i][rule.base]:
-            best[i-1][i][rule.base] = p
-            chart[i-1][i][rule.base] = [rule, i, None, None]
+      for r in self.rules.with_token(word):
+        rule = self.rules.rule(r)
+        p = rule.prob
+        if p > best[i-1][i][rule.base]:
+          best[i-1][i][rule.base] = p
+          chart[i-1][i][rule.base] = [rule, i, None, None]
 
     # Fill in other rows
     for l in range(2, n + 1):
       for i in range(0, n-l+1):
         j = i + l
-        for k in range(i+1, j):
-          binary_rules = filter(lambda x: len(x.chinese) == 2, self.rules)
-          for rule in binary_rules:
-            Y = rule.chinese[0]
-            Z = rule.chinese[1]
+        if self.span_memo is not None:
+          span = tuple(words[i:j])
+          cached = self.span_memo.get(span)
+          if cached is not None:
+            # Splits are kept relative to the start of the span
+            cell, scores = cached
+            for base, (rule, split) in cell.items():
+              chart[i][j][base] = [rule, i, j, i + split]
+            best[i][j].update(scores)
+            continue
 
-            y_set = [base for base in chart[i][k]]
-            z_set = [base for base in chart[k][j]]
+        # Number of the rule behind each entry, so that an equal score
+        # from an earlier rule at the same split still wins
+        cell_index = {}
+        for k in range(i+1, j):
+          for Y in chart[i][k]:
+            for Z in chart[k][j]:
+              for r in self.rules.with_pair(Y, Z):
+                rule = self.rules.rule(r)
+                p_prime = rule.prob * best[i][k][Y] * best[k][j][Z]
+                current = best[i][j][rule.base]
+                if p_prime > current or (p_prime == current and p_prime > 0.0
+                    and chart[i][j][rule.base][3] == k and r < cell_index[rule.base]):
+                  best[i][j][rule.base] = p_prime
+                  chart[i][j][rule.base] = [rule, i, j, k]
+                  cell_index[rule.base] = r
 
-            if Y in y_set and Z in z_set:
-              p_prime = rule.prob * best[i][k][Y] * best[k][j][Z]
-              if p_prime > best[i][j][rule.base]:
-                best[i][j][rule.base] = p_prime
-                chart[i][j][rule.base] = [rule, i, j, k]
+        if self.span_memo is not None:
+          cell = dict((base, (entry[0], entry[3] - i)) for base, entry in chart[i][j].items())
+          self.span_memo.put(span, (cell, dict(best[i][j])))
 
-    print(chart[0][n])
+    if verbose:
+      print(chart[0][n])
 
     def make_tree(chart, rule, i, j, k):
       if j is not None:
@@ -127,15 +321,127 @@ class Translator:
       # Parse Exists, backtrack to find full parse
       top_rule, i, j, k = chart[0][n]['PHRASE']
       tree = make_tree(chart, top_rule, i, j, k)
-      print(tree)
+      if verbose:
+        print(tree)
       return tree
     else:
       return None
 
+def _translate_in_worker(line):
+  translator, beam = forkpool.shared()
+  start = time.time()
+  translation = translator.translate(line, beam)
+  return translation, time.time() - start
+
+def translate_lines(translator, lines, workers=1, chunksize=1, beam=None):
+  """ Yields (translation, seconds taken) for every line, in input order.
+  With more than one worker the lines are translated in a pool of forked
+  processes, which share the translator's memory-mapped rule table, and
+  each result is yielded as soon as it and all earlier ones are done. If
+  the translator has a memo, the pool is only given lines that are not in
+  it, once each.
+  """
+  memo = translator.memo
+  if workers <= 1 or memo is None:
+    for result in forkpool.fork_imap(_translate_in_worker, lines, workers, chunksize, (translator, beam)):
+      yield result
+    return
+
+  # Translations of the lines already in the memo, and the first line of
+  # every other key, to be translated once
+  known = {}
+  pending = set()
+  todo = []
+  for line in lines:
+    key = translator.memo_key(line, beam)
+    if key in known or key in pending:
+      continue
+    translation = memo.get(key, _NOT_CACHED)
+    if translation is _NOT_CACHED:
+      pending.add(key)
+      todo.append(line)
+    else:
+      known[key] = translation
+
+  results = forkpool.fork_imap(_translate_in_worker, todo, workers, chunksize, (translator, beam))
+  try:
+    seen = set()
+    for line in lines:
+      start = time.time()
+      key = translator.memo_key(line, beam)
+      if key in seen:
+        # Counted as a hit, as it would be translating line by line
+        memo.hits += 1
+      seen.add(key)
+      if key in known:
+        yield known[key], time.time() - start
+        continue
+      # Keys are sent in order, so the next result is this line's
+      translation, seconds = next(results)
+      known[key] = translation
+      memo.put(key, translation)
+      yield translation, seconds
+  finally:
+    # Shuts the pool down
+    results.close()
+
+def translate_file(translator, filename, output, workers=1, chunksize=1, beam=None):
+  """ Writes the translation of every line of a file to output, one per
+  line and nothing else, and reports throughput and latency on stderr
+  """
+  with open(filename) as testFile:
+    lines = [line.strip() for line in testFile]
+
+  latencies = []
+  start = time.time()
+  with open(output, "w") as outputFile:
+    for translation, seconds in translate_lines(translator, lines, workers, chunksize, beam):
+      outputFile.write((translation or "") + "\n")
+      latencies.append(seconds)
+  elapsed = time.time() - start
+
+  latencies.sort()
+  sys.stderr.write("translated " + str(len(lines)) + " sentences in " + str(round(elapsed, 3)) + "s ("
+      + str(round(len(lines) / max(elapsed, 1e-9), 1)) + " sentences/sec)\n")
+  sys.stderr.write("latency ms: p50 %.2f p90 %.2f p99 %.2f max %.2f\n" % tuple(1000 * value
+      for value in [forkpool.percentile(latencies, 0.5), forkpool.percentile(latencies, 0.9),
+      forkpool.percentile(latencies, 0.99), latencies[-1] if latencies else 0.0]))
+  # Spans are memoized inside each worker, so a pool only reports lines
+  for name, (hits, lookups) in zip(["lines", "spans"], translator.memo_stats()):
+    if lookups:
+      sys.stderr.write("memo %s: %d of %d lookups hit (%.1f%%)\n" % (name, hits, lookups, 100.0 * hits / lookups))
+
 def main():
+  import argparse
+
+  argparser = argparse.ArgumentParser()
+  argparser.add_argument('rules', nargs='?', default='rules.binary', help='rule file')
+  argparser.add_argument('input', nargs='?', default='episode3-100.zh', help='sentences to translate')
+  argparser.add_argument('--output', default=None, help='write only the translations to this file')
+  argparser.add_argument('--workers', type=int, default=1, help='number of translator processes, with --output')
+  argparser.add_argument('--chunksize', type=int, default=1, help='sentences handed to a worker at a time')
+  argparser.add_argument('--beam', type=int, default=None, help='hypotheses kept per chart cell (see cube.py)')
+  argparser.add_argument('--lm', default=None, help='English text to train a language model on, with --beam')
+  argparser.add_argument('--lm-order', type=int, default=3, help='n of the language model')
+  argparser.add_argument('--lm-weight', type=float, default=1.0, help='exponent of the language model probability')
+  argparser.add_argument('--memo', type=int, default=10000, help='distinct lines whose translations are kept, with --output (0 to disable)')
+  argparser.add_argument('--span-memo', type=int, default=0, help='distinct runs of words whose chart cells are kept, with --output')
+  args = argparser.parse_args()
+  if args.lm is not None and args.beam is None:
+    argparser.error("--lm needs --beam")
+
   translator = Translator()
-  translator.train("rules.binary")
-  translator.test_file("episode3-100.zh")
+  translator.train(args.rules)
+  translator.use_memo(args.memo, args.span_memo)
+  if args.lm is not None:
+    from lm import WordNGramModel
+    lm = WordNGramModel(args.lm_order)
+    lm.train(args.lm)
+    translator.use_language_model(lm, args.lm_weight)
+  if args.output is None:
+    translator.test_file(args.input, args.beam)
+  else:
+    translate_file(translator, args.input, args.output, args.workers, args.chunksize, args.beam)
 
 if __name__ == "__main__":
   main()